@@ -1,26 +1,66 @@
 from uuid import uuid4
 from flask import Flask
-from flask import request, jsonify
+from flask import request, jsonify, g, Response
 import hashlib
+import logging
+import time
 from flask_cors import CORS
 
-from src.process import validate_dataset, summarize_answers, upload_file, load_data_and_preprocess, pca, upload_results, kmeans, get_uploaded_result_by_uuid, summarize_answer_per_cluster, upload_student_data
-from src.db import get_student_data_by_uuid_and_name, create_db, get_db_connection, close_db_connection, authenticate, insert_user, insert_result_record, get_user_records, delete_record, test_db_connection, get_all_users, delete_user, update_student_cluster
-from src.classification import svm_classification, random_forest_classification, neural_network_classification
+from src.process import summarize_answers, ingest_upload, store_upload, get_uploaded_result_by_uuid, load_results_payload, upload_path, UploadDigest, OUT_OF_CORE_MB
+from src.schemas import DatasetSchemaError, get_form_schema
+from src.models import predict_clusters
+from src.storage import stream_student_data, EXPORT_FORMATS
+from src.db import get_student_data_by_uuid_and_name, create_db, get_db_connection, close_db_connection, authenticate, insert_user, get_user_records, delete_record, test_db_connection, get_all_users, delete_user, update_student_cluster, update_student_clusters
+from src.db import insert_result_record, find_dataset, resolve_dataset, detach_dataset, get_form_datasets
+from src.neighbors import similar_students, SIMILAR_STUDENTS_MAX_K
+from src.jobs import create_job, get_job, submit_job, complete_job, fail_interrupted_jobs
+from src.cache import cache_stats
+from src.archive import collect_garbage, disk_usage, start_collector
+from src.metrics import observe, render_metrics
 
 import os
+import pandas as pd
+
+# Level of the application log, e.g. DEBUG to also log request parameters
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'
 allowed_origin = os.environ.get("ALLOW_ORIGIN", "*")
 CORS(app, resources={r"/api/*": {"origins": allowed_origin}})
 
-create_db(password=hashlib.sha256('admin1234'.encode()).hexdigest())
-conn = get_db_connection()
-print("Connection:", conn)
-close_db_connection(conn)
-superadmin = authenticate('superadmin', hashlib.sha256('admin1234'.encode()).hexdigest())
-print("Superadmin:", superadmin)
+def bootstrap_db():
+    create_db(password=hashlib.sha256('admin1234'.encode()).hexdigest())
+    conn = get_db_connection()
+    logger.debug("Connection: %s", conn)
+    close_db_connection(conn)
+    superadmin = authenticate('superadmin', hashlib.sha256('admin1234'.encode()).hexdigest())
+    logger.info("Superadmin available: %s", superadmin is not None)
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Creates the database tables and the default superadmin account (run once)."""
+    bootstrap_db()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        # The route pattern rather than the path, so ids do not become labels
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        observe('http_request_seconds', time.perf_counter() - start, method=request.method, endpoint=endpoint, status=response.status_code)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Stage, DB and request timings, processed row counts and cache hit ratios of this worker process."""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def hello_world():
@@ -28,7 +68,7 @@ def hello_world():
 
 @app.route('/test')
 def test():
-    print(test_db_connection()[0])
+    logger.debug(test_db_connection()[0])
     return 
 
 # API ROUTES
@@ -81,19 +121,76 @@ def delete_user_by_id(id):
     else:
         return jsonify({'message': 'User deletion failed'}), 500
 #======================================================================================
+# job status and cache endpoints
+#======================================================================================
+@app.route('/api/jobs/<string:job_id>', methods=['GET'])
+def get_job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'message': 'Job not found'}), 404
+    return jsonify(job), 200
+
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(cache_stats()), 200
+
+@app.route('/api/storage/usage', methods=['GET'])
+def get_storage_usage():
+    return jsonify(disk_usage()), 200
+
+@app.route('/api/storage/collect', methods=['POST'])
+def collect_storage():
+    # Also runs every GC_INTERVAL seconds in the background
+    return jsonify(collect_garbage()), 200
+
+#======================================================================================
 # data fetch endpoints
 #======================================================================================
 @app.route('/api/data', methods=['GET'])
 def get_data():
     user = request.args.get('username')
-    print(user)
     records = get_user_records(user)
     return jsonify({'records': records}), 200
 
 @app.route('/api/data/<string:type>/<string:uuid>', methods=['GET'])
 def get_data_by_uuid(type, uuid):
-    result = get_uploaded_result_by_uuid(uuid, type)
-    return jsonify(result), 200
+    # Records sharing a dataset are still reported under their own id
+    payload = load_results_payload(resolve_dataset(uuid), type, record_id=uuid)
+    if payload is None:
+        return jsonify(None), 200
+    # The stored bytes are served as they are; clients revalidate with If-None-Match and mostly get a 304
+    if request.if_none_match.contains_weak(payload['etag']):
+        response = Response(status=304)
+    else:
+        encoding = request.accept_encodings.best_match([encoding for encoding in ('br', 'gzip') if encoding in payload], default='identity')
+        response = Response(payload[encoding], mimetype='application/json')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(payload['etag'], weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.route('/api/data/<string:type>/<string:uuid>/export', methods=['GET'])
+def export_data(type, uuid):
+    file_format = request.args.get('format', 'csv')
+    try:
+        chunks = stream_student_data(
+            resolve_dataset(uuid), type, file_format,
+            # Repeated, since question headers may contain commas
+            columns=request.args.getlist('column'),
+            gender=request.args.get('gender', 'all'),
+            grade=request.args.get('grade', 'all'),
+            cluster=request.args.get('cluster', 'all'),
+        )
+    except FileNotFoundError:
+        return jsonify({'message': 'Record not found'}), 404
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    # The rows are converted and sent chunk by chunk as the client reads them
+    response = Response(chunks, mimetype=EXPORT_FORMATS[file_format])
+    response.headers['Content-Disposition'] = f'attachment; filename="{uuid}.{file_format}"'
+    return response
 
 @app.route('/api/data/<string:uuid>', methods=['DELETE'])
 def delete_data_by_uuid(uuid):
@@ -105,17 +202,102 @@ def delete_data_by_uuid(uuid):
 
 @app.route('/api/student/data/<string:uuid>/<string:form_type>/<string:name>', methods=['GET'])
 def get_student_data_by_name(uuid, form_type, name):
-    result = get_student_data_by_uuid_and_name(uuid, name, form_type)
+    occurrence = request.args.get('occurrence', 0, type=int)
+    result = get_student_data_by_uuid_and_name(resolve_dataset(uuid), name, form_type, occurrence)
     return jsonify(result), 200
 
+@app.route('/api/student/data/<string:uuid>/<string:form_type>/<string:name>/similar', methods=['GET'])
+def get_similar_students(uuid, form_type, name):
+    k = request.args.get('k', 10, type=int)
+    occurrence = request.args.get('occurrence', 0, type=int)
+    scope = request.args.get('scope', 'record')
+    if not 1 <= k <= SIMILAR_STUDENTS_MAX_K:
+        return jsonify({'message': f'k must be between 1 and {SIMILAR_STUDENTS_MAX_K}'}), 400
+    if scope not in ('record', 'form'):
+        return jsonify({'message': "scope must be 'record' or 'form'"}), 400
+
+    dataset_uuid = resolve_dataset(uuid)
+    # With scope=form every record of the form type is searched, each dataset once
+    datasets = get_form_datasets(form_type) if scope == 'form' else {}
+    datasets[dataset_uuid] = uuid
+    groups = similar_students(dataset_uuid, form_type, name, k=k, occurrence=occurrence, datasets=datasets)
+    if groups is None:
+        return jsonify({'message': 'Student not found'}), 404
+    response = {'id': uuid, 'type': form_type, 'name': name, 'scope': scope, 'students': groups[0]['students']}
+    if scope == 'form':
+        # Each other record is ranked in its own PCA space, so its distances are not comparable to these
+        response['other_records'] = groups[1:]
+    return jsonify(response), 200
+
+def _cluster_count(uuid, form_type):
+    # Number of clusters of a record's dataset, or None if the record has no results
+    results = get_uploaded_result_by_uuid(resolve_dataset(uuid), form_type)
+    return None if results is None else int(results['data_summary']['cluster_summary']['optimal_k'])
+
 @app.route('/api/student/data/<string:uuid>/<string:form_type>/<string:name>/<string:cluster>', methods=['PUT'])
 def update_student_cluster_by_name(uuid, name, form_type, cluster):
-    result = update_student_cluster(uuid, name, cluster, form_type)
+    occurrence = request.args.get('occurrence', 0, type=int)
+    cluster_count = _cluster_count(uuid, form_type)
+    if cluster_count is None:
+        return jsonify({'message': 'Record not found'}), 404
+    try:
+        cluster = int(cluster)
+    except ValueError:
+        cluster = -1
+    if not 0 <= cluster < cluster_count:
+        return jsonify({'message': f'cluster must be an integer between 0 and {cluster_count - 1}'}), 400
+    result = detach_dataset(uuid, form_type) and update_student_cluster(uuid, name, cluster, form_type, occurrence)
     if result:
         return jsonify({'message': 'Student cluster updated successfully'}), 200
     else:
         return jsonify({'message': 'Student cluster update failed'}), 500
     
+@app.route('/api/student/data/<string:uuid>/<string:form_type>/clusters', methods=['PUT'])
+def update_student_clusters_in_batch(uuid, form_type):
+    data = request.get_json(silent=True) or {}
+    changes = data.get('changes')
+    if not isinstance(changes, list) or not changes:
+        return jsonify({'message': 'Missing changes'}), 400
+    try:
+        changes = [(str(change['name']), int(change['cluster']), int(change.get('occurrence', 0))) for change in changes]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return jsonify({'message': 'Each change needs a name, an integer cluster and optionally an integer occurrence'}), 400
+    cluster_count = _cluster_count(uuid, form_type)
+    if cluster_count is None:
+        return jsonify({'message': 'Record not found'}), 404
+    if any(not 0 <= cluster < cluster_count for _, cluster, _ in changes):
+        return jsonify({'message': f'Every cluster must be between 0 and {cluster_count - 1}'}), 400
+
+    unknown = update_student_clusters(uuid, changes, form_type) if detach_dataset(uuid, form_type) else False
+    if unknown is False:
+        return jsonify({'message': 'Student cluster update failed'}), 500
+    return jsonify({'message': 'Student clusters updated successfully', 'updated': len(changes) - len(unknown), 'unknown': unknown}), 200
+
+@app.route('/api/predict/<string:uuid>', methods=['POST'])
+def predict_student_clusters(uuid):
+    form_type = request.args.get('type') or request.form.get('kindOfData')
+    use_classifier = request.args.get('model') == 'classifier'
+    try:
+        if 'file' in request.files:
+            df = pd.read_csv(request.files['file'].stream, dtype={'Name': str})
+        else:
+            data = request.get_json(silent=True) or {}
+            form_type = form_type or data.get('type')
+            students = data.get('students')
+            if not isinstance(students, list) or not students:
+                return jsonify({'message': 'Missing students'}), 400
+            df = pd.DataFrame(students)
+        predictions = predict_clusters(resolve_dataset(uuid), form_type, df, use_classifier=use_classifier)
+    except DatasetSchemaError as e:
+        return jsonify({'message': str(e), 'missing_columns': e.missing, 'extra_columns': e.extra}), 400
+    except Exception as e:
+        logger.exception("Error predicting clusters for %s", uuid)
+        return jsonify({'message': 'Prediction failed'}), 500
+
+    if predictions is None:
+        return jsonify({'message': 'No stored models for this dataset'}), 404
+    return jsonify({'id': uuid, 'type': form_type, 'predictions': predictions}), 200
+
 @app.route('/api/answer_summary', methods=['GET'])
 def get_answer_summary():
     uuid = request.args.get('uuid')
@@ -123,22 +305,16 @@ def get_answer_summary():
     gender = request.args.get("gender", "all")
     grade = request.args.get("grade", "all")
     cluster = request.args.get("cluster", "all")
-    print("UUID:", uuid)
-    print("Form Type:", form_type)
-    print("Gender:", gender)
-    print("Grade:", grade)
-    print("Cluster:", cluster)
-    summary = summarize_answers(uuid, form_type, gender, grade, cluster)
+    logger.debug("Answer summary for %s (%s): gender=%s grade=%s cluster=%s", uuid, form_type, gender, grade, cluster)
+    summary = summarize_answers(resolve_dataset(uuid), form_type, gender, grade, cluster)
     return jsonify(summary), 200
 
 @app.route('/api/data', methods=['POST'])
 def fetch_data():
     if 'file' not in request.files:
-        print("Error: No file part in request")
         return jsonify({'message': 'No file part in request'}), 400
     file = request.files['file']
     if file.filename == '':
-        print("Error: No selected file")
         return jsonify({'message': 'No selected file'}), 400
     
     if file and file.filename.lower().endswith('.csv'):
@@ -147,66 +323,80 @@ def fetch_data():
         form_type = request.form.get('kindOfData')
         user = request.form.get('user')
         if not user:
-            print("Error: User not provided in form data")
             return jsonify({'message': 'User not found'}), 400
 
-        file_path = upload_file(file, uuid, form_type)
-
-        df, df_questions_only, df_scaled = load_data_and_preprocess(file_path, form_type)
-        columns = df.columns.to_list()
-        is_valid = validate_dataset(columns, form_type)
-        if not is_valid:
-            print("Error: Invalid dataset. Columns:", columns)
+        # Large uploads are only streamed to disk here and processed from there in chunks
+        out_of_core = (request.content_length or 0) > OUT_OF_CORE_MB * 1024 * 1024
+        try:
+            # An unknown form type gets the schema's 400 before anything is hashed or stored
+            if get_form_schema(form_type) is None:
+                raise DatasetSchemaError(form_type)
+            digest = UploadDigest(form_type)
+            if out_of_core:
+                df, saved_path = None, store_upload(file, uuid, form_type, digest=digest)
+            else:
+                df, saved_path = ingest_upload(file, uuid, form_type, digest=digest), None
+        except DatasetSchemaError as e:
+            return jsonify({'message': str(e), 'missing_columns': e.missing, 'extra_columns': e.extra}), 400
+        if df is None and saved_path is None:
             return jsonify({'message': 'Invalid dataset'}), 400
 
-        df_pca, optimal_pc = pca(df_scaled)
-        df_pca, optimal_k, cluster_count, df_original_questions_only = kmeans(df_pca, df_questions_only)
-        
-        upload_student_data(df_pca, uuid, form_type)
-        summary = summarize_answers(uuid, form_type, 'all', 'all', 'all')
-
-        svm_summary = svm_classification(df_pca, 'Cluster') 
-        rf_summary = random_forest_classification(df_pca, 'Cluster')
-        nn_summary = neural_network_classification(df_pca, 'Cluster')
-
-        best_accuracy = 0
-        best_model = None
-        
-        for model in [svm_summary, rf_summary, nn_summary]:
-            if model['accuracy'] > best_accuracy:
-                best_accuracy = model['accuracy']
-                best_model = model
-
-
-        results = {
-            'id': uuid,
-            'user': user,
-            'type': form_type,
-            'data_summary': {
-                'answers_summary': summary,
-                'pca_summary': {
-                    'optimal_pc': optimal_pc
-                },
-                'cluster_summary': {
-                    'optimal_k': optimal_k,
-                    'cluster_count': cluster_count
-                },
-                'classification_summary': best_model
-            }
-        }
-        
-        print("Results:", results)
-        results_path = upload_results(results)
-        if not insert_result_record(uuid, record_name, user, form_type) or not results_path:
-            print("Error: Failed to insert result record or get results_path")
-            return jsonify({'message': 'Failed to insert result record'}), 500
-
-        return jsonify({'message': 'File uploaded and processed successfully', 'data': results}), 200
+        # The same export uploaded again reuses the computed dataset instead of another pipeline run
+        content_hash = digest.hexdigest()
+        dataset_uuid = find_dataset(content_hash, form_type)
+        results = get_uploaded_result_by_uuid(dataset_uuid, form_type) if dataset_uuid else None
+        if results is not None and insert_result_record(uuid, record_name, user, form_type, dataset_uuid=dataset_uuid):
+            os.remove(upload_path(uuid, form_type))
+            results.update(id=uuid, user=user)
+            job_id = create_job([], record_id=uuid, type=form_type, user=user, out_of_core=out_of_core, deduplicated=True)
+            complete_job(job_id, results)
+            return jsonify({'message': 'Identical upload already processed', 'job_id': job_id, 'id': uuid}), 202
+
+        # The ML pipeline is imported on first upload so read-only workers start fast
+        from src.pipeline import UPLOAD_PIPELINE_STAGES, run_upload_pipeline
+        job_id = create_job(UPLOAD_PIPELINE_STAGES, record_id=uuid, type=form_type, user=user, out_of_core=out_of_core, deduplicated=False)
+        submit_job(job_id, run_upload_pipeline, df, uuid, record_name, form_type, user, upload_path=saved_path, content_hash=content_hash)
+
+        return jsonify({'message': 'File uploaded, processing started', 'job_id': job_id, 'id': uuid}), 202
     
     else:
-        print("Error: Invalid file type. Only CSV files are accepted.")
         return jsonify({'message': 'Invalid file type. Only CSV files are accepted.'}), 400
 
+@app.route('/api/data/<string:type>/<string:uuid>/append', methods=['POST'])
+def append_data(type, uuid):
+    file = request.files.get('file')
+    if file is None or not file.filename.lower().endswith('.csv'):
+        return jsonify({'message': 'A CSV file is required'}), 400
+    user = request.form.get('user')
+    if not user:
+        return jsonify({'message': 'User not found'}), 400
+    if get_uploaded_result_by_uuid(resolve_dataset(uuid), type) is None:
+        return jsonify({'message': 'Record not found'}), 404
+
+    # Each wave is kept next to the original upload
+    wave = f'{uuid}.{uuid4().hex[:8]}'
+    try:
+        df = ingest_upload(file, wave, type)
+    except DatasetSchemaError as e:
+        return jsonify({'message': str(e), 'missing_columns': e.missing, 'extra_columns': e.extra}), 400
+    if df is None:
+        return jsonify({'message': 'Invalid dataset'}), 400
+
+    # New rows must not show up in records that share this one's dataset; only detached once the wave is valid
+    if not detach_dataset(uuid, type):
+        os.remove(upload_path(wave, type))
+        return jsonify({'message': 'Append failed'}), 500
+
+    from src.pipeline import APPEND_PIPELINE_STAGES, APPEND_DRIFT_THRESHOLD, run_append_pipeline
+    drift_threshold = request.form.get('driftThreshold', APPEND_DRIFT_THRESHOLD, type=float)
+    job_id = create_job(APPEND_PIPELINE_STAGES, record_id=uuid, type=type, user=user)
+    submit_job(job_id, run_append_pipeline, df, uuid, type, user, drift_threshold=drift_threshold)
+
+    return jsonify({'message': 'File uploaded, appending started', 'job_id': job_id, 'id': uuid}), 202
+
 
 if __name__ == '__main__':
+    bootstrap_db()
+    fail_interrupted_jobs()
+    start_collector()
     app.run(host='0.0.0.0', port=5000, debug=True)
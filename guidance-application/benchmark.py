@@ -0,0 +1,281 @@
+"""Benchmarks each upload pipeline stage at several dataset sizes.
+
+Datasets are built from the 500-row slices in data/sliced/<form>/ (repeated
+when a size exceeds the bundled rows). Every stage reports wall time,
+rows/sec and peak resident memory as JSON; two runs can be compared to
+catch regressions.
+
+    python benchmark.py run --output bench.json
+    python benchmark.py run --forms ASSI-C --sizes 500 2500 --stages pca kmeans
+    python benchmark.py compare baseline.json bench.json --tolerance 0.1
+
+compare exits with status 1 when a stage got slower than the tolerance.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+
+import pandas as pd
+
+from src.process import ingest_upload, load_data_and_preprocess, pca, kmeans, upload_student_data, summarize_answers
+from src.classification import prepare_classification_data, fit_svm, fit_random_forest, fit_neural_network
+from src.cache import cache_invalidate
+
+ROOT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+SLICED_FOLDER = os.path.join(ROOT_FOLDER, 'data', 'sliced')
+
+FORMS = ['ASSI-A', 'ASSI-C']
+SIZES = [500, 1000, 1500, 2000, 2500]
+STAGES = ['ingest_upload', 'load_data_and_preprocess', 'pca', 'kmeans', 'svm', 'random_forest', 'neural_network', 'student_data', 'summarize_answers']
+
+# How often the memory sampler reads the resident set size, in seconds
+RSS_SAMPLE_INTERVAL = 0.005
+
+
+def _current_rss():
+    """Resident set size of this process in bytes, or None if it cannot be read."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class _PeakRSS:
+    """Samples the resident set size on a background thread while the block runs."""
+
+    def __enter__(self):
+        self.start = _current_rss()
+        self.peak = self.start
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._done.wait(RSS_SAMPLE_INTERVAL):
+            rss = _current_rss()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        rss = _current_rss()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+        return False
+
+
+class _Upload:
+    # Stands in for the werkzeug FileStorage that ingest_upload reads from
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+
+def load_sliced_dataset(form_type, rows):
+    """Concatenates the bundled slices of form_type in order, repeating them to reach rows."""
+    folder = os.path.join(SLICED_FOLDER, form_type)
+    slices = sorted(os.listdir(folder), key=lambda f: int(f.rsplit('.', 2)[-2]))
+    df = pd.concat([pd.read_csv(os.path.join(folder, f), dtype={'Name': str}) for f in slices], ignore_index=True)
+    repeats = -(-rows // len(df))
+    return pd.concat([df] * repeats, ignore_index=True).head(rows)
+
+
+def _measure(results, form_type, rows, stage, repeat, fn):
+    timings = []
+    peaks = []
+    deltas = []
+    value = None
+    for _ in range(repeat):
+        with _PeakRSS() as memory:
+            start = time.perf_counter()
+            value = fn()
+            timings.append(time.perf_counter() - start)
+        if memory.peak is not None:
+            peaks.append(memory.peak)
+            deltas.append(memory.peak - memory.start)
+
+    seconds = statistics.median(timings)
+    results.append({
+        'form': form_type,
+        'rows': rows,
+        'stage': stage,
+        'seconds': round(seconds, 6),
+        'rows_per_sec': round(rows / seconds, 1) if seconds > 0 else None,
+        'peak_rss_mb': round(max(peaks) / 2**20, 1) if peaks else None,
+        'rss_delta_mb': round(max(deltas) / 2**20, 1) if deltas else None,
+    })
+    print(f"{form_type:7} {rows:>7} {stage:26} {seconds:9.4f}s", file=sys.stderr)
+    return value
+
+
+def benchmark_dataset(form_type, rows, stages, repeat=1):
+    """Runs the pipeline stages in order on one dataset size and returns one result per selected stage.
+
+    Stages that are not selected still run once (untimed) when a later
+    stage needs their output.
+    """
+    results = []
+    csv_bytes = load_sliced_dataset(form_type, rows).to_csv(index=False).encode('utf-8')
+    uuid = f'bench-{rows}'
+
+    def run(stage, fn):
+        if stage in stages:
+            return _measure(results, form_type, rows, stage, repeat, fn)
+        return fn()
+
+    df = run('ingest_upload', lambda: ingest_upload(_Upload(csv_bytes), uuid, form_type))
+    if df is None:
+        raise RuntimeError(f'Could not ingest the {form_type} slices')
+    df, df_questions_only, df_scaled = run('load_data_and_preprocess', lambda: load_data_and_preprocess(df, form_type))
+    df_pca, _ = run('pca', lambda: pca(df_scaled))
+    df_pca, _, _, _ = run('kmeans', lambda: kmeans(df_pca.copy(), df_questions_only.copy()))
+
+    data = prepare_classification_data(df_pca, 'Cluster')
+    for stage, fit in [('svm', fit_svm), ('random_forest', fit_random_forest), ('neural_network', fit_neural_network)]:
+        if stage in stages:
+            _measure(results, form_type, rows, stage, repeat, lambda: fit(*data))
+
+    if 'student_data' in stages or 'summarize_answers' in stages:
+        run('student_data', lambda: upload_student_data(df_pca, df, uuid, form_type))
+
+    def summarize_cold():
+        # Measure the read path from disk rather than the cache
+        cache_invalidate((form_type, uuid, 'answer_cube'))
+        return summarize_answers(uuid, form_type, 'all', 'all', 'all')
+
+    if 'summarize_answers' in stages:
+        run('summarize_answers', summarize_cold)
+    return results
+
+
+def _environment():
+    import numpy
+    import sklearn
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'pandas': pd.__version__,
+        'numpy': numpy.__version__,
+        'scikit-learn': sklearn.__version__,
+    }
+
+
+def run_benchmarks(forms, sizes, stages, repeat=1):
+    """Benchmarks every form and size inside a scratch directory and returns the report."""
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='guidance-bench-') as scratch:
+        # The pipeline writes uploads/, student_data/ and results/ relative to the working directory
+        os.chdir(scratch)
+        try:
+            for form_type in forms:
+                for rows in sizes:
+                    results.extend(benchmark_dataset(form_type, rows, stages, repeat))
+        finally:
+            os.chdir(cwd)
+    return {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': repeat,
+        'environment': _environment(),
+        'results': results,
+    }
+
+
+def compare_reports(baseline, current, tolerance=0.1, min_seconds=0.005):
+    """Matches results by form, rows and stage and returns (rows, regressions).
+
+    A stage regresses when it is more than tolerance slower than the
+    baseline and the difference exceeds min_seconds (to ignore timer noise
+    on very fast stages).
+    """
+    before = {(r['form'], r['rows'], r['stage']): r for r in baseline['results']}
+    rows = []
+    regressions = []
+    for result in current['results']:
+        old = before.get((result['form'], result['rows'], result['stage']))
+        if old is None:
+            continue
+        ratio = result['seconds'] / old['seconds'] if old['seconds'] > 0 else None
+        row = {
+            'form': result['form'],
+            'rows': result['rows'],
+            'stage': result['stage'],
+            'baseline_seconds': old['seconds'],
+            'seconds': result['seconds'],
+            'ratio': round(ratio, 3) if ratio is not None else None,
+            'baseline_peak_rss_mb': old.get('peak_rss_mb'),
+            'peak_rss_mb': result.get('peak_rss_mb'),
+        }
+        rows.append(row)
+        if ratio is not None and ratio > 1 + tolerance and result['seconds'] - old['seconds'] > min_seconds:
+            regressions.append(row)
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='benchmark the pipeline stages')
+    run.add_argument('--forms', nargs='+', default=FORMS, choices=FORMS)
+    run.add_argument('--sizes', nargs='+', type=int, default=SIZES)
+    run.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    run.add_argument('--repeat', type=int, default=1, help='runs per stage; the median time is reported')
+    run.add_argument('--output', help='write the JSON report here instead of stdout')
+    run.add_argument('--baseline', help='compare against this earlier report after running')
+    run.add_argument('--tolerance', type=float, default=0.1)
+
+    compare = commands.add_parser('compare', help='compare two reports')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--tolerance', type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        report = run_benchmarks(args.forms, args.sizes, args.stages, args.repeat)
+        text = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                f.write(text)
+        else:
+            print(text)
+        if not args.baseline:
+            return 0
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        current = report
+    else:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        with open(args.current, encoding='utf-8') as f:
+            current = json.load(f)
+
+    rows, regressions = compare_reports(baseline, current, args.tolerance)
+    for row in rows:
+        flag = '  REGRESSION' if row in regressions else ''
+        print(f"{row['form']:7} {row['rows']:>7} {row['stage']:26} {row['baseline_seconds']:9.4f}s -> {row['seconds']:9.4f}s  x{row['ratio']}{flag}", file=sys.stderr)
+    print(f"{len(regressions)} regression(s) over {len(rows)} compared stages", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,55 @@
+"""Generates synthetic ASSI-A / ASSI-C response files from the bundled samples.
+
+Rows are drawn from the sample file of the form with replacement, so the
+joint answer patterns (and therefore the clusters) are kept. A share of the
+answers (--noise) is then redrawn from that question's overall distribution,
+so the output is not just copies of the sample. Written in chunks, so
+million-row files need little memory.
+
+    python data/generate_data.py ASSI-C 1000000 -o assi-c-1m.csv
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+root_folder = os.path.dirname(os.path.abspath(__file__))
+SOURCE_FILES = {
+    'ASSI-A': 'Annual Student Screening and Interview (ASSI-A) - Alternate Form (Responses).xlsx - Form Responses 1.csv',
+    'ASSI-C': 'Annual Student Screening and Interview (ASSI-C) - Alternate Form (Responses).xlsx - Form Responses 1.csv',
+}
+
+
+def generate_responses(source, rows, seed=42, noise=0.1, chunk_rows=100000):
+    """Yields DataFrame chunks with rows synthetic responses shaped like source."""
+    rng = np.random.default_rng(seed)
+    answers = source.columns[3:]
+    marginals = {col: source[col].dropna().to_numpy() for col in answers}
+
+    for start in range(0, rows, chunk_rows):
+        n = min(chunk_rows, rows - start)
+        chunk = source.iloc[rng.integers(0, len(source), n)].reset_index(drop=True)
+        for col in answers:
+            redraw = rng.random(n) < noise
+            chunk.loc[redraw, col] = rng.choice(marginals[col], redraw.sum())
+        chunk['Name'] = np.arange(start + 1, start + n + 1)
+        yield chunk
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('form', choices=sorted(SOURCE_FILES))
+    parser.add_argument('rows', type=int)
+    parser.add_argument('-o', '--output', required=True)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--noise', type=float, default=0.1, help='share of answers redrawn independently')
+    args = parser.parse_args()
+
+    source = pd.read_csv(os.path.join(root_folder, SOURCE_FILES[args.form]))
+    for i, chunk in enumerate(generate_responses(source, args.rows, args.seed, args.noise)):
+        chunk.to_csv(args.output, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from src.storage import iter_student_data, answer_columns
+from src.cache import cache_get, cache_put
+from src.concurrency import atomic_path, dataset_lock
+
+RESULTS_FOLDER = 'results'
+CUBE_DIMENSIONS = ['Gender', 'Grade', 'Cluster']
+
+
+def answer_cube_path(uuid, form_type):
+    return os.path.join(RESULTS_FOLDER, form_type, f'{uuid}.cube.feather')
+
+
+def _melt_answers(df):
+    # One row per (student, question); Cluster is also summarized as a question of its own
+    df = df.dropna(axis=0)
+    questions = answer_columns(df.columns) + ['Cluster']
+    long = df[CUBE_DIMENSIONS].join(df[questions].add_prefix('q:')).melt(
+        id_vars=CUBE_DIMENSIONS, var_name='question', value_name='answer'
+    )
+    long['question'] = pd.Categorical(long['question'].str[2:], categories=questions)
+    return long
+
+
+def _count(long):
+    cube = (long.groupby(['question', 'answer'] + CUBE_DIMENSIONS, observed=True)
+                .size()
+                .rename('count')
+                .reset_index())
+    return cube[cube['count'] > 0].reset_index(drop=True)
+
+
+def build_answer_cube(df):
+    """Counts students per question x answer x gender x grade x cluster in one groupby."""
+    return _count(_melt_answers(df))
+
+
+def save_answer_cube(cube, uuid, form_type):
+    file_path = answer_cube_path(uuid, form_type)
+    with atomic_path(file_path) as tmp_path:
+        feather.write_feather(pa.Table.from_pandas(cube, preserve_index=False), tmp_path, compression='uncompressed')
+    cache_put((form_type, uuid, 'answer_cube'), cube)
+    return file_path
+
+
+def refresh_answer_cube(uuid, form_type):
+    """Rebuilds the cube from the stored student data and saves it.
+
+    Uses the cached dataset when there is one; otherwise the file is counted
+    one record batch at a time, so large datasets are never loaded whole.
+    """
+    cached = cache_get((form_type, uuid))
+    if cached is not None:
+        cube = build_answer_cube(cached)
+    else:
+        cube = None
+        for df in iter_student_data(uuid, form_type):
+            counts = build_answer_cube(df)
+            cube = counts if cube is None else _merge_counts(cube, [counts])
+    save_answer_cube(cube, uuid, form_type)
+    return cube
+
+
+def load_answer_cube(uuid, form_type):
+    """Loads the stored cube, building it first for datasets processed before cubes existed."""
+    cached = cache_get((form_type, uuid, 'answer_cube'))
+    if cached is not None:
+        return cached
+
+    file_path = answer_cube_path(uuid, form_type)
+    with dataset_lock(uuid, form_type, shared=True):
+        if not os.path.exists(file_path):
+            return refresh_answer_cube(uuid, form_type)
+        return cache_put((form_type, uuid, 'answer_cube'), feather.read_table(file_path, memory_map=True).to_pandas())
+
+
+def summarize_answer_cube(cube, gender, grade, cluster):
+    """Slices the cube into the {question: {answer: count}} shape of summarize_answers."""
+    mask = pd.Series(True, index=cube.index)
+    if gender != 'all':
+        mask &= cube['Gender'] == gender
+    if grade != 'all':
+        mask &= cube['Grade'] == int(grade)
+    if cluster != 'all':
+        mask &= cube['Cluster'] == int(cluster)
+
+    counts = (cube[mask].groupby(['question', 'answer'], observed=True)['count']
+                        .sum()
+                        .reset_index()
+                        .sort_values(['question', 'count'], ascending=[True, False], kind='stable'))
+
+    summary = {question: {} for question in cube['question'].cat.categories}
+    for question, answer, count in zip(counts['question'], counts['answer'].tolist(), counts['count'].tolist()):
+        summary[question][answer] = count
+    return summary
+
+
+def _merge_counts(cube, deltas):
+    # Sums count deltas into the cube, dropping cells that reach zero
+    keys = ['question', 'answer'] + CUBE_DIMENSIONS
+    combined = pd.concat([cube] + deltas, ignore_index=True)
+    combined['question'] = pd.Categorical(combined['question'], categories=cube['question'].cat.categories)
+    cube = combined.groupby(keys, observed=True)['count'].sum().reset_index()
+    return cube[cube['count'] > 0].reset_index(drop=True)
+
+
+def move_students_in_cube(uuid, form_type, rows, new_cluster):
+    """Moves the given student rows (with their current Cluster) to new_cluster in the stored cube."""
+    rows = rows[rows['Cluster'] != new_cluster]
+    if rows.empty:
+        return
+    cube = load_answer_cube(uuid, form_type)
+
+    removed = _count(_melt_answers(rows))
+    moved = rows.copy()
+    moved['Cluster'] = new_cluster
+    added = _count(_melt_answers(moved))
+    removed['count'] = -removed['count']
+    save_answer_cube(_merge_counts(cube, [removed, added]), uuid, form_type)
+
+
+def add_students_to_cube(uuid, form_type, rows):
+    """Adds newly appended student rows (answer codes and Cluster) to the stored cube."""
+    if rows.empty:
+        return
+    cube = load_answer_cube(uuid, form_type)
+    save_answer_cube(_merge_counts(cube, [_count(_melt_answers(rows))]), uuid, form_type)
@@ -0,0 +1,267 @@
+import json
+import logging
+import os
+import shutil
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.artifacts import dataset_files, upload_files, remove_dataset
+from src.answer_cube import RESULTS_FOLDER
+from src.concurrency import LOCKS_FOLDER, SCRATCH_FOLDER, atomic_path, dataset_lock, scratch_dir, remove_scratch_dir
+from src.db import DB_NAME, drop_dataset, get_archived_records, get_dataset_users, get_form_datasets
+from src.jobs import JOBS_FOLDER, sweep_saved_jobs
+from src.metrics import inc
+from src.models import MODELS_FOLDER, model_dir
+from src.process import UPLOADS_FOLDER, results_path
+from src.storage import STUDENT_DATA_FOLDER, stream_student_data
+
+ARCHIVE_FOLDER = 'archive'
+# Seconds between two runs of the background garbage collector (0 turns it off)
+GC_INTERVAL = int(os.environ.get('GC_INTERVAL', 3600))
+# Files changed less than this many seconds ago are never collected, e.g. those of an upload still processing
+GC_GRACE_PERIOD = int(os.environ.get('GC_GRACE_PERIOD', 3600))
+# Archives are deleted this many days after they were written (0 keeps them forever)
+ARCHIVE_RETENTION_DAYS = float(os.environ.get('ARCHIVE_RETENTION_DAYS', 0))
+
+# Folders holding per-dataset files, as <folder>/<form_type>/<uuid>...
+DATASET_FOLDERS = [UPLOADS_FOLDER, STUDENT_DATA_FOLDER, RESULTS_FOLDER, MODELS_FOLDER]
+
+# Archiving and collection run one at a time, off the request threads
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="archive")
+_collector = None
+_collector_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def archive_path(uuid, form_type):
+    return os.path.join(ARCHIVE_FOLDER, form_type, f'{uuid}.tar.xz')
+
+
+def _dataset_paths(uuid, form_type):
+    # Every existing file of a dataset, models included
+    paths = [path for path in dataset_files(uuid, form_type) + upload_files(uuid, form_type) if os.path.exists(path)]
+    for directory, _, file_names in os.walk(model_dir(uuid, form_type)):
+        paths += [os.path.join(directory, file_name) for file_name in file_names]
+    return paths
+
+
+def _size(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+def archive_dataset(uuid, form_type):
+    """Packs a dataset no record uses any more into a tar.xz archive and deletes its files.
+
+    The archive keeps what the dataset cannot be rebuilt without: the raw
+    uploads, the results and the student data as CSV, with text answers and
+    the final clusters including counselor changes. Models and other derived
+    files are dropped. Returns the bytes freed, which is negative when the
+    archive outgrows a tiny dataset, or None if a record uses the dataset or
+    it has no files.
+    """
+    with dataset_lock(uuid, form_type):
+        if uuid in get_form_datasets(form_type):
+            return None
+        paths = _dataset_paths(uuid, form_type)
+        if not paths:
+            drop_dataset(uuid, form_type)
+            return None
+        size = _size(paths)
+
+        # The student data is exported to a file first, since tar needs each member's size up front
+        directory = scratch_dir(f'archive-{form_type}-{uuid}')
+        try:
+            csv_path = os.path.join(directory, 'student_data.csv')
+            try:
+                with open(csv_path, 'w', encoding='utf-8', newline='') as f:
+                    for chunk in stream_student_data(uuid, form_type):
+                        f.write(chunk)
+            except FileNotFoundError:
+                # The upload was never processed
+                csv_path = None
+            manifest_path = os.path.join(directory, 'manifest.json')
+            with open(manifest_path, 'w', encoding='utf-8') as f:
+                json.dump({'uuid': uuid, 'form_type': form_type, 'archived_at': time.time(),
+                           'records': get_archived_records(uuid)}, f, ensure_ascii=False, indent=4)
+
+            with atomic_path(archive_path(uuid, form_type)) as tmp_path, tarfile.open(tmp_path, 'w:xz') as tar:
+                tar.add(manifest_path, arcname='manifest.json')
+                for file_path in upload_files(uuid, form_type):
+                    tar.add(file_path, arcname=os.path.join('uploads', os.path.basename(file_path)))
+                if os.path.exists(results_path(uuid, form_type)):
+                    tar.add(results_path(uuid, form_type), arcname='results.json')
+                if csv_path:
+                    tar.add(csv_path, arcname='student_data.csv')
+        finally:
+            remove_scratch_dir(os.path.basename(directory))
+
+        remove_dataset(uuid, form_type)
+        drop_dataset(uuid, form_type)
+
+    freed = size - os.path.getsize(archive_path(uuid, form_type))
+    inc('gc_archived_datasets_total', form_type=form_type)
+    inc('gc_reclaimed_bytes_total', max(freed, 0), kind='dataset')
+    logger.info("Archived dataset %s/%s, %d bytes freed", form_type, uuid, freed)
+    return freed
+
+
+def _run_logged(fn, *args):
+    try:
+        return fn(*args)
+    except Exception:
+        logger.exception("%s%s failed", fn.__name__, args)
+
+
+def schedule_archive(uuid, form_type):
+    """Archives a dataset in the background, e.g. right after its last record was deleted."""
+    return _executor.submit(_run_logged, archive_dataset, uuid, form_type)
+
+
+def _datasets_on_disk():
+    # {(form_type, uuid): newest modification time} of every dataset with files
+    datasets = {}
+    for folder in DATASET_FOLDERS:
+        if not os.path.isdir(folder):
+            continue
+        for form_type in os.listdir(folder):
+            form_folder = os.path.join(folder, form_type)
+            if not os.path.isdir(form_folder):
+                continue
+            for entry in os.scandir(form_folder):
+                if entry.name.startswith('.'):
+                    continue
+                # <uuid>.csv, <uuid>.<wave>.csv, <uuid>.json.gz, models/<form>/<uuid>/ ...
+                key = (form_type, entry.name.split('.')[0])
+                datasets[key] = max(datasets.get(key, 0), entry.stat().st_mtime)
+    return datasets
+
+
+def _remove(path, kind):
+    # Removes a file or folder and counts the bytes freed
+    if os.path.isdir(path):
+        size = sum(_size([os.path.join(d, f) for f in files]) for d, _, files in os.walk(path))
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        size = os.path.getsize(path)
+        os.remove(path)
+    inc('gc_reclaimed_bytes_total', size, kind=kind)
+    return size
+
+
+def collect_garbage():
+    """Archives orphaned datasets and deletes leftover files; returns a summary of what was reclaimed.
+
+    Orphaned datasets are files on disk that no record uses, e.g. of records
+    deleted before archiving existed or of a run that failed before its
+    record was saved. Leftovers are scratch folders of finished jobs,
+    temporary files of interrupted writes, lock files of datasets that are
+    gone and archives past ARCHIVE_RETENTION_DAYS. Anything changed within
+    GC_GRACE_PERIOD, and the datasets of queued or running jobs, is skipped.
+    """
+    cutoff = time.time() - GC_GRACE_PERIOD
+    jobs = sweep_saved_jobs()
+    active_jobs = {job['id'] for job in jobs if job['status'] in ('queued', 'running')}
+    active_records = {job.get('record_id') for job in jobs if job['id'] in active_jobs}
+    summary = {'archived': [], 'removed': 0, 'reclaimed_bytes': 0}
+
+    live = {}
+    for (form_type, uuid), modified in sorted(_datasets_on_disk().items()):
+        if form_type not in live:
+            live[form_type] = get_form_datasets(form_type)
+        if uuid in live[form_type] or uuid in active_records or modified > cutoff:
+            continue
+        freed = archive_dataset(uuid, form_type)
+        if freed is not None:
+            summary['archived'].append({'uuid': uuid, 'form_type': form_type})
+            summary['reclaimed_bytes'] += max(freed, 0)
+
+    leftovers = []
+    if os.path.isdir(SCRATCH_FOLDER):
+        leftovers += [(entry.path, 'scratch') for entry in os.scandir(SCRATCH_FOLDER)
+                      if entry.name not in active_jobs and entry.stat().st_mtime < cutoff]
+    for folder in DATASET_FOLDERS + [ARCHIVE_FOLDER, JOBS_FOLDER]:
+        for directory, _, file_names in os.walk(folder):
+            leftovers += [(os.path.join(directory, file_name), 'temp') for file_name in file_names
+                          if file_name.startswith('.') and file_name.endswith('.tmp')
+                          and os.path.getmtime(os.path.join(directory, file_name)) < cutoff]
+    on_disk = _datasets_on_disk()
+    if os.path.isdir(LOCKS_FOLDER):
+        for form_type in os.listdir(LOCKS_FOLDER):
+            for entry in os.scandir(os.path.join(LOCKS_FOLDER, form_type)):
+                uuid = entry.name.split('.')[0]
+                if (form_type, uuid) not in on_disk and uuid not in active_records and entry.stat().st_mtime < cutoff:
+                    leftovers.append((entry.path, 'locks'))
+    if ARCHIVE_RETENTION_DAYS > 0 and os.path.isdir(ARCHIVE_FOLDER):
+        expired = time.time() - ARCHIVE_RETENTION_DAYS * 86400
+        for directory, _, file_names in os.walk(ARCHIVE_FOLDER):
+            leftovers += [(os.path.join(directory, file_name), 'archive') for file_name in file_names
+                          if not file_name.startswith('.') and os.path.getmtime(os.path.join(directory, file_name)) < expired]
+
+    for path, kind in leftovers:
+        try:
+            summary['reclaimed_bytes'] += _remove(path, kind)
+            summary['removed'] += 1
+        except OSError as e:
+            logger.warning("Could not remove %s: %s", path, e)
+
+    logger.info("Garbage collection archived %d datasets, removed %d leftovers, freed %d bytes",
+                len(summary['archived']), summary['removed'], summary['reclaimed_bytes'])
+    return summary
+
+
+def start_collector():
+    """Starts the background thread that runs collect_garbage every GC_INTERVAL seconds, once per process."""
+    global _collector
+    with _collector_lock:
+        if GC_INTERVAL <= 0 or _collector is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(GC_INTERVAL)
+                _executor.submit(_run_logged, collect_garbage).result()
+
+        _collector = threading.Thread(target=run, name='collector', daemon=True)
+        _collector.start()
+
+
+def _folder_size(folder):
+    return sum(_size([os.path.join(directory, f) for f in file_names]) for directory, _, file_names in os.walk(folder))
+
+
+def disk_usage():
+    """Reports the bytes on disk by user, by form type and by folder.
+
+    A dataset counts for the user of the record that owns it, or of a record
+    sharing it once the owner is deleted. An archive counts for the user of
+    the last record of its dataset, even after that user was deleted.
+    """
+    by_user = {}
+    by_form_type = {}
+
+    def add(user, form_type, kind, size):
+        if user is not None:
+            by_user.setdefault(user, {'active': 0, 'archived': 0})[kind] += size
+        by_form_type.setdefault(form_type, {'active': 0, 'archived': 0})[kind] += size
+
+    for (form_type, uuid), user in get_dataset_users().items():
+        add(user, form_type, 'active', _size(_dataset_paths(uuid, form_type)))
+
+    archive_users = {(record['type'], record['dataset_uuid']): record['username'] for record in get_archived_records()}
+    if os.path.isdir(ARCHIVE_FOLDER):
+        for form_type in os.listdir(ARCHIVE_FOLDER):
+            for entry in os.scandir(os.path.join(ARCHIVE_FOLDER, form_type)):
+                if not entry.name.startswith('.'):
+                    add(archive_users.get((form_type, entry.name.split('.')[0])), form_type, 'archived', entry.stat().st_size)
+
+    folders = {folder: _folder_size(folder) for folder in DATASET_FOLDERS + [ARCHIVE_FOLDER, SCRATCH_FOLDER, JOBS_FOLDER, LOCKS_FOLDER]}
+    folders['database'] = _size([DB_NAME, DB_NAME + '-wal', DB_NAME + '-shm'])
+    return {
+        'total': sum(folders.values()),
+        'by_user': by_user,
+        'by_form_type': by_form_type,
+        'folders': folders,
+    }
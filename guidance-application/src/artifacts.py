@@ -0,0 +1,70 @@
+import glob
+import json
+import os
+import shutil
+
+from src.storage import student_data_path
+from src.answer_cube import answer_cube_path
+from src.models import model_dir
+from src.process import results_path, upload_path, upload_results
+from src.neighbors import embedding_path
+from src.cache import cache_invalidate
+from src.concurrency import atomic_path
+
+# Cache entries kept per dataset next to the dataset frame itself, keyed (form_type, uuid, kind)
+_CACHED_KINDS = ['answer_cube', 'student_index', 'pipeline', 'classifier', 'results', 'neighbors']
+# Files stored next to the results of a dataset by upload_results
+_RESULTS_SUFFIXES = ['.etag', '.gz', '.br']
+
+
+def dataset_files(uuid, form_type):
+    """Paths of the computed files of a dataset (the models folder aside), whether or not they exist."""
+    return [
+        student_data_path(uuid, form_type),
+        student_data_path(uuid, form_type, 'index.json'),
+        student_data_path(uuid, form_type, 'csv'),
+        answer_cube_path(uuid, form_type),
+        embedding_path(uuid, form_type),
+        results_path(uuid, form_type),
+    ] + [results_path(uuid, form_type) + suffix for suffix in _RESULTS_SUFFIXES]
+
+
+def copy_dataset(source, target, form_type):
+    """Copies the computed files and models of dataset source so they belong to dataset target.
+
+    Used to give a record that shared another upload's results its own copy
+    before it is modified. Raw uploads are not copied.
+    """
+    for source_path, target_path in zip(dataset_files(source, form_type), dataset_files(target, form_type)):
+        if not os.path.exists(source_path):
+            continue
+        if source_path == results_path(source, form_type):
+            # Rewritten under the new id, which also gives it its own ETag and compressed copies
+            with open(source_path, 'r', encoding='utf-8') as f:
+                results = json.load(f)
+            results['id'] = target
+            if not upload_results(results):
+                raise OSError(f'Could not copy the results of {form_type}/{source}')
+        elif not source_path.startswith(results_path(source, form_type)):
+            with atomic_path(target_path) as tmp_path:
+                shutil.copyfile(source_path, tmp_path)
+
+    if os.path.isdir(model_dir(source, form_type)):
+        shutil.copytree(model_dir(source, form_type), model_dir(target, form_type), dirs_exist_ok=True)
+
+
+def upload_files(uuid, form_type):
+    """Paths of the raw uploads of a dataset: the original upload and any appended waves (<uuid>.<wave>.csv)."""
+    return sorted(glob.glob(os.path.join(os.path.dirname(upload_path(uuid, form_type)), glob.escape(uuid) + '*.csv')))
+
+
+def remove_dataset(uuid, form_type):
+    """Deletes every file of a dataset, including its raw uploads and models, and drops it from the cache."""
+    for file_path in dataset_files(uuid, form_type) + upload_files(uuid, form_type):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    shutil.rmtree(model_dir(uuid, form_type), ignore_errors=True)
+
+    cache_invalidate((form_type, uuid))
+    for kind in _CACHED_KINDS:
+        cache_invalidate((form_type, uuid, kind))
@@ -0,0 +1,122 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from src.concurrency import dataset_generation
+
+# Memory budget for cached datasets, in megabytes
+DATASET_CACHE_MB = float(os.environ.get('DATASET_CACHE_MB', 256))
+
+_entries = OrderedDict()  # key -> (value, size in bytes, dataset generation), least recently used first
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+_kind_stats = {}  # kind of entry -> {'hits', 'misses'}
+
+
+def _kind(key):
+    # (form_type, uuid) is a whole dataset; longer keys name what they hold, e.g. 'answer_cube'
+    if isinstance(key, tuple) and len(key) > 2:
+        return str(key[2])
+    return 'dataset'
+
+
+def _generation(key):
+    # Keys start with (form_type, uuid); other processes bump the generation when they write the dataset
+    if isinstance(key, tuple) and len(key) >= 2:
+        return dataset_generation(key[1], key[0])
+    return 0
+
+
+def _sizeof(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum()) if isinstance(value, pd.DataFrame) else int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        # e.g. served results or a neighbour index, which hold their data in the values
+        return sys.getsizeof(value) + sum(_sizeof(item) for item in value.values())
+    return sys.getsizeof(value)
+
+
+def _evict_to_budget(budget):
+    while _entries and _stats['bytes'] > budget:
+        _, (_, size, _) = _entries.popitem(last=False)
+        _stats['bytes'] -= size
+        _stats['evictions'] += 1
+
+
+def cache_get(key):
+    """Returns the cached value for key (marking it recently used), or None on a miss.
+
+    Cached values are shared between requests and must not be mutated in place.
+    Entries of a dataset another process wrote since they were cached count
+    as misses.
+    """
+    generation = _generation(key)
+    with _lock:
+        entry = _entries.get(key)
+        kind_stats = _kind_stats.setdefault(_kind(key), {'hits': 0, 'misses': 0})
+        if entry is not None and entry[2] != generation:
+            del _entries[key]
+            _stats['bytes'] -= entry[1]
+            entry = None
+        if entry is None:
+            _stats['misses'] += 1
+            kind_stats['misses'] += 1
+            return None
+        _entries.move_to_end(key)
+        _stats['hits'] += 1
+        kind_stats['hits'] += 1
+        return entry[0]
+
+
+def cache_put(key, value):
+    """Stores value under key, evicting least recently used entries beyond the memory budget."""
+    size = _sizeof(value)
+    generation = _generation(key)
+    budget = DATASET_CACHE_MB * 1024 * 1024
+    with _lock:
+        old = _entries.pop(key, None)
+        if old is not None:
+            _stats['bytes'] -= old[1]
+        if size > budget:
+            # Larger than the whole budget; serve it uncached rather than flushing everything
+            return value
+        _entries[key] = (value, size, generation)
+        _stats['bytes'] += size
+        _evict_to_budget(budget)
+    return value
+
+
+def cache_invalidate(key):
+    with _lock:
+        old = _entries.pop(key, None)
+        if old is not None:
+            _stats['bytes'] -= old[1]
+
+
+def cache_restamp(form_type, uuid, old_generation, new_generation):
+    """Moves the entries of a dataset cached at old_generation to new_generation, after this process wrote it."""
+    with _lock:
+        for key, (value, size, generation) in _entries.items():
+            if isinstance(key, tuple) and key[:2] == (form_type, uuid) and generation == old_generation:
+                _entries[key] = (value, size, new_generation)
+
+
+def cache_stats():
+    with _lock:
+        lookups = _stats['hits'] + _stats['misses']
+        return {
+            **_stats,
+            'entries': len(_entries),
+            'budget_bytes': int(DATASET_CACHE_MB * 1024 * 1024),
+            'hit_ratio': round(_stats['hits'] / lookups, 4) if lookups else None,
+            'by_kind': {
+                kind: {**counts, 'hit_ratio': round(counts['hits'] / (counts['hits'] + counts['misses']), 4)}
+                for kind, counts in _kind_stats.items()
+            }
+        }
@@ -1,17 +1,20 @@
+import logging
+import os
 import pandas as pd
+import multiprocessing
+import time
+from queue import Empty
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
 from sklearn.svm import SVC
 from sklearn.metrics import accuracy_score, classification_report, confusion_matrix
 from sklearn.ensemble import RandomForestClassifier
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense
-from tensorflow.keras.optimizers import Adam
 import numpy as np
 from sklearn.preprocessing import LabelEncoder
-from tensorflow.keras.utils import to_categorical
 
-def svm_classification(df: pd.DataFrame, target_column: str) -> dict:
+logger = logging.getLogger(__name__)
+
+def _split_and_scale(df: pd.DataFrame, target_column: str) -> tuple:
     # Separate features and target
     X = df.drop(columns=[target_column, 'Name', 'Grade'])
     y = df[target_column]
@@ -26,89 +29,72 @@ def svm_classification(df: pd.DataFrame, target_column: str) -> dict:
     X_train_scaled = scaler.fit_transform(X_train)
     X_test_scaled = scaler.transform(X_test)
 
-    # Initialize and train the SVM classifier
-    clf = SVC(kernel='rbf', random_state=42)
-    clf.fit(X_train_scaled, y_train)
+    return (X_train_scaled, X_test_scaled, y_train.to_numpy(), y_test.to_numpy()), scaler
 
-    # Make predictions on the test set
-    y_pred = clf.predict(X_test_scaled)
+def prepare_classification_data(df: pd.DataFrame, target_column: str) -> tuple:
+    return _split_and_scale(df, target_column)[0]
 
+def _summarize_predictions(model_name, y_test, y_pred) -> dict:
     # Compute metrics
     accuracy = accuracy_score(y_test, y_pred)
     report = classification_report(y_test, y_pred, output_dict=True)
     matrix = confusion_matrix(y_test, y_pred)
 
     return {
-        'model_name': 'SVM',
+        'model_name': model_name,
         'accuracy': accuracy,
         'report': report,
-        'confusion_matrix': matrix.tolist()  # Convert to list if needed
+        'confusion_matrix': matrix.tolist()
     }
 
-def random_forest_classification(df: pd.DataFrame, target_column: str) -> dict:
-    # Separate features and target
-    X = df.drop(columns=[target_column, 'Name', 'Grade'])
-    y = df[target_column]
-
-    # Split data into training and testing sets
-    X_train, X_test, y_train, y_test = train_test_split(
-        X, y, test_size=0.2, random_state=42
-    )
+def _save_sklearn_model(clf, model_path):
+    import joblib
 
-    # Optionally scale features (scaling is not mandatory for Random Forest)
-    scaler = StandardScaler()
-    X_train_scaled = scaler.fit_transform(X_train)
-    X_test_scaled = scaler.transform(X_test)
+    if model_path:
+        joblib.dump(clf, f'{model_path}.joblib')
 
-    # Initialize and train the Random Forest classifier
-    clf = RandomForestClassifier(n_estimators=100, random_state=42)
+def fit_svm(X_train_scaled, X_test_scaled, y_train, y_test, model_path=None) -> dict:
+    # Initialize and train the SVM classifier
+    clf = SVC(kernel='rbf', random_state=42)
     clf.fit(X_train_scaled, y_train)
 
     # Make predictions on the test set
     y_pred = clf.predict(X_test_scaled)
+    _save_sklearn_model(clf, model_path)
+    return _summarize_predictions('SVM', y_test, y_pred)
 
-    # Compute metrics
-    accuracy = accuracy_score(y_test, y_pred)
-    report = classification_report(y_test, y_pred, output_dict=True)
-    matrix = confusion_matrix(y_test, y_pred)
+def fit_random_forest(X_train_scaled, X_test_scaled, y_train, y_test, model_path=None) -> dict:
+    # Initialize and train the Random Forest classifier on all cores
+    clf = RandomForestClassifier(n_estimators=100, random_state=42, n_jobs=-1)
+    clf.fit(X_train_scaled, y_train)
 
-    return {
-        'model_name': 'Random Forest',
-        'accuracy': accuracy,
-        'report': report,
-        'confusion_matrix': matrix.tolist()
-    }
+    # Make predictions on the test set
+    y_pred = clf.predict(X_test_scaled)
+    _save_sklearn_model(clf, model_path)
+    return _summarize_predictions('Random Forest', y_test, y_pred)
 
-def neural_network_classification(df: pd.DataFrame, target_column: str) -> dict:
-    # Separate features and target
-    X = df.drop(columns=[target_column, 'Name', 'Grade'])
-    y = df[target_column]
+def fit_neural_network(X_train_scaled, X_test_scaled, y_train, y_test, model_path=None) -> dict:
+    # TensorFlow is imported here so it is only loaded by the process that fits the network
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.layers import Dense
+    from tensorflow.keras.optimizers import Adam
+    from tensorflow.keras.utils import to_categorical
 
     # Encode target labels if necessary
-    if y.dtype == object or y.dtype == 'str':
+    if y_train.dtype == object or y_train.dtype == 'str':
         le = LabelEncoder()
-        y = le.fit_transform(y)
+        le.fit(np.concatenate([y_train, y_test]))
+        y_train = le.transform(y_train)
+        y_test = le.transform(y_test)
 
     # Determine the number of classes
-    num_classes = np.unique(y).shape[0]
-
-    # Split data into training and testing sets
-    X_train, X_test, y_train, y_test = train_test_split(
-        X, y, test_size=0.2, random_state=42
-    )
-
-    # Scale features
-    scaler = StandardScaler()
-    X_train_scaled = scaler.fit_transform(X_train)
-    X_test_scaled = scaler.transform(X_test)
+    num_classes = np.unique(np.concatenate([y_train, y_test])).shape[0]
 
     # For neural network training, if more than 2 classes, use one-hot encoding
     if num_classes > 2:
         y_train_cat = to_categorical(y_train, num_classes=num_classes)
-        y_test_cat = to_categorical(y_test, num_classes=num_classes)
     else:
         y_train_cat = y_train
-        y_test_cat = y_test
 
     # Build a simple neural network model
     model = Sequential()
@@ -137,14 +123,123 @@ def neural_network_classification(df: pd.DataFrame, target_column: str) -> dict:
     else:
         y_pred = (y_pred_prob > 0.5).astype(int).flatten()
 
-    # Compute metrics
-    accuracy = accuracy_score(y_test, y_pred)
-    report = classification_report(y_test, y_pred, output_dict=True)
-    matrix = confusion_matrix(y_test, y_pred)
+    if model_path:
+        model.save(f'{model_path}.keras')
 
-    return {
-        'model_name': 'Neural Network',
-        'accuracy': accuracy,
-        'report': report,
-        'confusion_matrix': matrix.tolist()
-    }
\ No newline at end of file
+    return _summarize_predictions('Neural Network', y_test, y_pred)
+
+CLASSIFIERS = {
+    'SVM': fit_svm,
+    'Random Forest': fit_random_forest,
+    'Neural Network': fit_neural_network,
+}
+
+def svm_classification(df: pd.DataFrame, target_column: str) -> dict:
+    return fit_svm(*prepare_classification_data(df, target_column))
+
+def random_forest_classification(df: pd.DataFrame, target_column: str) -> dict:
+    return fit_random_forest(*prepare_classification_data(df, target_column))
+
+def neural_network_classification(df: pd.DataFrame, target_column: str) -> dict:
+    return fit_neural_network(*prepare_classification_data(df, target_column))
+
+def _model_path(model_dir, name):
+    return os.path.join(model_dir, name.lower().replace(' ', '_')) if model_dir else None
+
+def _fit_in_process(name, fit, data, queue, model_path):
+    try:
+        queue.put((name, fit(*data, model_path=model_path), None))
+    except Exception as e:
+        queue.put((name, None, str(e)))
+
+def run_model_selection(df: pd.DataFrame, target_column: str, time_budget: float = None, model_dir: str = None, max_rows: int = None) -> dict:
+    """Fits every classifier in parallel on one shared split and returns the most accurate summary.
+
+    Each model is fitted in its own process. Models still running when
+    time_budget (seconds) runs out are dropped and their processes terminated.
+    Returns None if no model finished. Datasets over max_rows rows are
+    subsampled first, since SVC training grows roughly quadratically.
+
+    With model_dir, every model saves itself there (joblib for scikit-learn,
+    .keras for the network) and only the winner is kept, together with the
+    feature scaler as scaler.joblib; the summary then names the saved file
+    under 'model_file'.
+    """
+    if max_rows and len(df) > max_rows:
+        df = df.sample(n=max_rows, random_state=42)
+    data, scaler = _split_and_scale(df, target_column)
+    if model_dir:
+        os.makedirs(model_dir, exist_ok=True)
+
+    # Spawned rather than forked: a child forked from a process that has loaded TensorFlow (e.g. to
+    # predict with a stored network) deadlocks on TensorFlow's inherited locks. Plain (non-daemonic)
+    # processes so the Random Forest can still fan out across cores
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    processes = {
+        name: context.Process(target=_fit_in_process, args=(name, fit, data, queue, _model_path(model_dir, name)))
+        for name, fit in CLASSIFIERS.items()
+    }
+    for process in processes.values():
+        process.start()
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+
+    summaries = []
+    finished = set()
+
+    def collect(name, summary, error):
+        finished.add(name)
+        if error is not None:
+            logger.error("Error in %s classification: %s", name, error)
+        else:
+            summaries.append(summary)
+
+    while len(finished) < len(processes):
+        timeout = 1.0 if deadline is None else min(1.0, max(0, deadline - time.monotonic()))
+        try:
+            collect(*queue.get(timeout=timeout))
+        except Empty:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            # A worker that died without reporting (e.g. killed for memory) will never answer,
+            # but one that just exited may have put its result after the get above timed out
+            if not any(p.is_alive() for n, p in processes.items() if n not in finished):
+                while True:
+                    try:
+                        collect(*queue.get_nowait())
+                    except Empty:
+                        break
+                break
+
+    dropped = [name for name in processes if name not in finished]
+    if dropped:
+        logger.warning("Classification did not finish within the time budget of %ss, dropped: %s", time_budget, ', '.join(dropped))
+    for name, process in processes.items():
+        if name in dropped:
+            process.terminate()
+        process.join()
+
+    best_accuracy = 0
+    best_model = None
+
+    for model in summaries:
+        if model['accuracy'] > best_accuracy:
+            best_accuracy = model['accuracy']
+            best_model = model
+
+    if model_dir:
+        import joblib
+
+        kept = None
+        for name in CLASSIFIERS:
+            for extension in ('joblib', 'keras'):
+                file_path = f'{_model_path(model_dir, name)}.{extension}'
+                if best_model is not None and name == best_model['model_name'] and os.path.exists(file_path):
+                    kept = os.path.basename(file_path)
+                elif os.path.exists(file_path):
+                    os.remove(file_path)
+        if kept:
+            joblib.dump(scaler, os.path.join(model_dir, 'scaler.joblib'))
+            best_model['model_file'] = kept
+
+    return best_model
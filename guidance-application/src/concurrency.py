@@ -0,0 +1,167 @@
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl, and no multi-process WSGI server either; the thread locks below suffice there
+    fcntl = None
+
+LOCKS_FOLDER = 'locks'
+SCRATCH_FOLDER = 'scratch'
+
+# os.umask can only be read by setting it, so it is read once here rather than racing other threads later
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+@contextmanager
+def atomic_path(file_path):
+    """Yields a unique temporary path next to file_path and renames it over file_path if the block succeeds.
+
+    Readers see either the old or the new file, never a partial one, and
+    concurrent writers of the same file do not share a temporary name. The
+    file keeps the mode of the file it replaces, or gets the umask default
+    of a plain open() when new, instead of mkstemp's owner-only mode.
+    """
+    directory = os.path.dirname(file_path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(file_path)}.', suffix='.tmp')
+    os.close(fd)
+    try:
+        yield tmp_path
+        try:
+            mode = stat.S_IMODE(os.stat(file_path).st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class _ReadWriteLock:
+    """In-process readers/writer lock; waiting writers keep new readers out so they are not starved."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire(self, shared):
+        with self._condition:
+            if shared:
+                while self._writer or self._waiting_writers:
+                    self._condition.wait()
+                self._readers += 1
+            else:
+                self._waiting_writers += 1
+                while self._writer or self._readers:
+                    self._condition.wait()
+                self._waiting_writers -= 1
+                self._writer = True
+
+    def release(self, shared):
+        with self._condition:
+            if shared:
+                self._readers -= 1
+            else:
+                self._writer = False
+            self._condition.notify_all()
+
+
+_locks = {}
+_locks_lock = threading.Lock()
+_held = threading.local()  # per thread: lock key -> [shared, depth]
+
+
+def lock_path(uuid, form_type, name='data'):
+    return os.path.join(LOCKS_FOLDER, form_type, f'{uuid}.{name}.lock')
+
+
+def dataset_generation(uuid, form_type):
+    """Changes whenever a writer releases the data lock of a dataset, in any process (0 if never written)."""
+    try:
+        return os.stat(lock_path(uuid, form_type)).st_mtime_ns
+    except OSError:
+        return 0
+
+
+@contextmanager
+def dataset_lock(uuid, form_type, shared=False, name='data'):
+    """Holds the readers/writer lock of a dataset for the block, across threads and processes.
+
+    Readers (shared=True) run together; a writer runs alone. Re-entering a
+    lock the thread already holds is free, but a reader cannot become a
+    writer. Releasing the 'data' lock after writing bumps the dataset
+    generation, which tells other processes their cached copies are stale.
+    Other names give independent locks, e.g. 'append' to queue appends.
+    """
+    key = (form_type, uuid, name)
+    held = getattr(_held, 'locks', None)
+    if held is None:
+        held = _held.locks = {}
+    if key in held:
+        if held[key][0] and not shared:
+            raise RuntimeError(f'Cannot upgrade the read lock of {form_type}/{uuid} to a write lock')
+        held[key][1] += 1
+        try:
+            yield
+        finally:
+            held[key][1] -= 1
+        return
+
+    with _locks_lock:
+        lock = _locks.setdefault(key, _ReadWriteLock())
+    lock.acquire(shared)
+    held[key] = [shared, 1]
+    lock_file = None
+    generation = None
+    try:
+        if fcntl is not None:
+            path = lock_path(uuid, form_type, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            lock_file = open(path, 'a+b')
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        generation = dataset_generation(uuid, form_type)
+        yield
+    finally:
+        # Also after a failure, since some files may already have been replaced
+        if not shared and name == 'data' and generation is not None:
+            _bump_generation(uuid, form_type, generation)
+        if lock_file is not None:
+            lock_file.close()
+        del held[key]
+        lock.release(shared)
+
+
+def _bump_generation(uuid, form_type, generation):
+    # cache imports this module, so it is imported here
+    from src.cache import cache_restamp
+
+    path = lock_path(uuid, form_type)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a+b'):
+        pass
+    now = time.time_ns()
+    os.utime(path, ns=(now, max(now, generation + 1)))
+    # Entries that were current when the lock was taken were kept current by this process's writes
+    cache_restamp(form_type, uuid, generation, dataset_generation(uuid, form_type))
+
+
+def scratch_dir(job_id):
+    """Private working directory of a job, created on first use and removed by remove_scratch_dir."""
+    directory = os.path.join(SCRATCH_FOLDER, job_id)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def remove_scratch_dir(job_id):
+    shutil.rmtree(os.path.join(SCRATCH_FOLDER, job_id), ignore_errors=True)
@@ -1,37 +1,41 @@
+import logging
 import sqlite3
 import os
+import threading
 import pandas as pd
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from src.storage import load_student_data, save_student_data, append_student_data, decode_student_record, answer_columns, lookup_student, read_student_row
+from src.answer_cube import move_students_in_cube, add_students_to_cube
+from src.cache import cache_invalidate
+from src.artifacts import copy_dataset
+from src.concurrency import dataset_lock
+from src.metrics import timed, inc
+
 DB_NAME = "guidance_system.db"
+# Seconds a connection waits on a locked database before raising "database is locked"
+DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', 10))
 
-def get_db_connection():
-    """Creates and returns a database connection."""
-    connection = sqlite3.connect(DB_NAME)
-    connection.execute("PRAGMA foreign_keys = ON")  # Enable foreign keys
-    connection.row_factory = sqlite3.Row  # Enable dictionary-like row access
-    print("Connected to database")
-    return connection
+# Pending cluster overrides per dataset before they are compacted into the student data file
+COMPACT_OVERRIDES_AT = int(os.environ.get('COMPACT_OVERRIDES_AT', 100))
 
-def close_db_connection(connection):
-    """Closes the database connection."""
-    connection.close()
+# Deleted records; username is kept as plain text so the rows outlive their user
+ARCHIVED_RECORDS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS archived_records (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        uuid TEXT NOT NULL UNIQUE,
+        name TEXT NOT NULL,
+        username TEXT NOT NULL,
+        type TEXT CHECK(type IN ('ASSI-A', 'ASSI-C')) NOT NULL,
+        archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+"""
 
-def create_db(password):
-    """Creates the database and necessary tables if they do not exist."""
-    # Check if a directory with the same name exists and remove it
-    if os.path.isdir(DB_NAME):
-        os.rmdir(DB_NAME)
-        print(f"Removed directory with same name as database: {DB_NAME}")
-    
-    # Create the database file if it doesn't exist
-    if not os.path.exists(DB_NAME):
-        with open(DB_NAME, 'w') as f:
-            pass
-        print(f"Created new database file: {DB_NAME}")
-    connection = get_db_connection()
-    cursor = connection.cursor()
-    # Create users table
-    cursor.execute("""
+# Schema, applied in order by migrate_db; every statement must be idempotent
+SCHEMA = [
+    """
     CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         username TEXT NOT NULL UNIQUE,
@@ -41,10 +45,8 @@ def create_db(password):
         user_type TEXT CHECK(user_type IN ('admin', 'viewer')) NOT NULL DEFAULT 'viewer',
         created_at DATETIME DEFAULT CURRENT_TIMESTAMP
     )
-    """)
-
-    # Create records table
-    cursor.execute("""
+    """,
+    """
     CREATE TABLE IF NOT EXISTS records (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         uuid TEXT NOT NULL UNIQUE,
@@ -54,7 +56,175 @@ def create_db(password):
         created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY (username) REFERENCES users(username) ON DELETE CASCADE
     )
-    """)
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_records_username ON records (username)",
+    ARCHIVED_RECORDS_TABLE_SQL,
+    # Append-only log of counselor cluster reassignments
+    """
+    CREATE TABLE IF NOT EXISTS cluster_overrides (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        uuid TEXT NOT NULL,
+        form_type TEXT CHECK(form_type IN ('ASSI-A', 'ASSI-C')) NOT NULL,
+        name TEXT NOT NULL,
+        row_offset INTEGER NOT NULL,
+        cluster INTEGER NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_cluster_overrides_dataset ON cluster_overrides (uuid, form_type, id)",
+    # Computed datasets (files under their uuid) with the content hash of their upload and the number of records using them
+    """
+    CREATE TABLE IF NOT EXISTS datasets (
+        uuid TEXT PRIMARY KEY,
+        form_type TEXT CHECK(form_type IN ('ASSI-A', 'ASSI-C')) NOT NULL,
+        content_hash TEXT,
+        ref_count INTEGER NOT NULL DEFAULT 0,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_datasets_content ON datasets (content_hash, form_type)",
+    # Records whose upload matched an existing dataset, and the dataset they read from
+    """
+    CREATE TABLE IF NOT EXISTS shared_records (
+        uuid TEXT PRIMARY KEY,
+        dataset_uuid TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_shared_records_dataset ON shared_records (dataset_uuid)",
+    # Reference counts follow the records table, including deletes cascaded from users
+    """
+    CREATE TRIGGER IF NOT EXISTS records_add_reference AFTER INSERT ON records
+    BEGIN
+        UPDATE datasets SET ref_count = ref_count + 1
+        WHERE uuid = COALESCE((SELECT dataset_uuid FROM shared_records WHERE uuid = NEW.uuid), NEW.uuid);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS records_drop_reference AFTER DELETE ON records
+    BEGIN
+        UPDATE datasets SET ref_count = ref_count - 1
+        WHERE uuid = COALESCE((SELECT dataset_uuid FROM shared_records WHERE uuid = OLD.uuid), OLD.uuid);
+        DELETE FROM shared_records WHERE uuid = OLD.uuid;
+    END
+    """,
+]
+
+# Columns added to tables of existing databases: (table, column, definition)
+COLUMNS = [
+    # The dataset a deleted record used, whose archive holds its files
+    ('archived_records', 'dataset_uuid', 'TEXT'),
+]
+
+# Hot queries keep the same SQL text so each pooled connection reuses its prepared statement
+AUTHENTICATE_SQL = "SELECT * FROM users WHERE username = ? AND password_hash = ?"
+USER_RECORDS_SQL = "SELECT * FROM records WHERE username = ?"
+INSERT_RECORD_SQL = "INSERT INTO records (uuid, name, username, type) VALUES (?, ?, ?, ?)"
+ARCHIVE_RECORD_SQL = "INSERT INTO archived_records (uuid, name, username, type, dataset_uuid) VALUES (?, ?, ?, ?, ?)"
+# Records of a user with their dataset, archived before the user's deletion cascades to them
+USER_DATASET_RECORDS_SQL = """
+    SELECT r.uuid, r.name, r.username, r.type, COALESCE(s.dataset_uuid, r.uuid) AS dataset_uuid
+    FROM records r JOIN users u ON u.username = r.username LEFT JOIN shared_records s ON s.uuid = r.uuid
+    WHERE u.id = ?
+"""
+RESOLVE_DATASET_SQL = "SELECT dataset_uuid FROM shared_records WHERE uuid = ?"
+# A dataset whose last record is gone waits for the archiver; its upload hash is released so the
+# same upload is computed again under a new uuid instead of clashing with idx_datasets_content
+RELEASE_UNUSED_DATASETS_SQL = "UPDATE datasets SET content_hash = NULL WHERE ref_count <= 0 AND content_hash IS NOT NULL"
+# One record per dataset of a form type, preferring the record that owns the files
+FORM_DATASETS_SQL = """
+    SELECT COALESCE(s.dataset_uuid, r.uuid) AS dataset_uuid, MIN(CASE WHEN s.uuid IS NULL THEN r.uuid END) AS owner, MIN(r.uuid) AS uuid
+    FROM records r LEFT JOIN shared_records s ON s.uuid = r.uuid
+    WHERE r.type = ?
+    GROUP BY COALESCE(s.dataset_uuid, r.uuid)
+"""
+# Every record with its dataset, records owning their dataset first
+DATASET_USERS_SQL = """
+    SELECT COALESCE(s.dataset_uuid, r.uuid) AS dataset_uuid, r.type, r.username
+    FROM records r LEFT JOIN shared_records s ON s.uuid = r.uuid
+    ORDER BY s.uuid IS NOT NULL, r.id
+"""
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+_compaction_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compaction")
+
+logger = logging.getLogger(__name__)
+
+def _db_error(call, err):
+    logger.error("%s failed: %s", call, err)
+    inc('db_errors_total', call=call)
+
+def _open_connection():
+    connection = sqlite3.connect(DB_NAME, timeout=DB_BUSY_TIMEOUT, cached_statements=256)
+    connection.execute("PRAGMA foreign_keys = ON")  # Enable foreign keys
+    connection.execute("PRAGMA journal_mode = WAL")  # Readers no longer block the writer
+    connection.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT * 1000)}")
+    connection.row_factory = sqlite3.Row  # Enable dictionary-like row access
+    return connection
+
+def migrate_db(connection):
+    """Applies the schema to the database; safe to run repeatedly."""
+    global _schema_ready
+    with _schema_lock:
+        for statement in SCHEMA:
+            connection.execute(statement)
+        _add_columns(connection)
+        _drop_archived_records_user_key(connection)
+        connection.execute(RELEASE_UNUSED_DATASETS_SQL)
+        connection.commit()
+        _schema_ready = True
+
+def _add_columns(connection):
+    for table, column, definition in COLUMNS:
+        if column not in [row["name"] for row in connection.execute(f"PRAGMA table_info({table})")]:
+            connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def _drop_archived_records_user_key(connection):
+    # Older databases declared archived_records.username a cascading key to users, which
+    # erased the archive of a deleted user; SQLite can only drop it by rebuilding the table
+    if not connection.execute("PRAGMA foreign_key_list(archived_records)").fetchall():
+        return
+    connection.execute("ALTER TABLE archived_records RENAME TO archived_records_old")
+    connection.execute(ARCHIVED_RECORDS_TABLE_SQL)
+    _add_columns(connection)
+    columns = ', '.join(row["name"] for row in connection.execute("PRAGMA table_info(archived_records)"))
+    connection.execute(f"INSERT INTO archived_records ({columns}) SELECT {columns} FROM archived_records_old")
+    connection.execute("DROP TABLE archived_records_old")
+
+def get_db_connection():
+    """Returns this thread's pooled database connection, opening it on first use."""
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        connection = _open_connection()
+        _local.connection = connection
+        if not _schema_ready:
+            # Workers started without 'init-db' still get the schema, once per process
+            migrate_db(connection)
+    return connection
+
+def close_db_connection(connection):
+    """Releases a pooled connection; it stays open for reuse by the same thread."""
+    if connection.in_transaction:
+        connection.rollback()
+
+def create_db(password):
+    """Creates the database and necessary tables if they do not exist."""
+    # Check if a directory with the same name exists and remove it
+    if os.path.isdir(DB_NAME):
+        os.rmdir(DB_NAME)
+        logger.warning("Removed directory with same name as database: %s", DB_NAME)
+    
+    # Create the database file if it doesn't exist
+    if not os.path.exists(DB_NAME):
+        with open(DB_NAME, 'w') as f:
+            pass
+        logger.info("Created new database file: %s", DB_NAME)
+    connection = get_db_connection()
+    cursor = connection.cursor()
+    # Create tables and indexes
+    migrate_db(connection)
 
     # Insert default admin user if not exists
     cursor.execute("SELECT * FROM users WHERE username = 'superadmin'")
@@ -64,9 +234,10 @@ def create_db(password):
         VALUES ('superadmin', ?, 'Admin', 'User', 'admin')
         """, (password,))
     connection.commit()
-    print("Database tables created successfully")
+    logger.info("Database tables created successfully")
     close_db_connection(connection)
 
+@timed('db_call_seconds')
 def test_db_connection():
     """Tests the database connection by executing a simple query."""
     try:
@@ -78,16 +249,17 @@ def test_db_connection():
         close_db_connection(connection)
         return rows
     except sqlite3.Error as err:
-        print("SQLite Error:", err)
+        _db_error('test_db_connection', err)
         cursor.close()
         close_db_connection(connection)
         return False
 
+@timed('db_call_seconds')
 def authenticate(username, password):
     """Authenticates a user by verifying credentials against the database."""
     connection = get_db_connection()
     cursor = connection.cursor()
-    cursor.execute("SELECT * FROM users WHERE username = ? AND password_hash = ?", (username, password))
+    cursor.execute(AUTHENTICATE_SQL, (username, password))
     user = cursor.fetchone()
     cursor.close()
     close_db_connection(connection)
@@ -102,25 +274,13 @@ def authenticate(username, password):
         }
     return None
 
+@timed('db_call_seconds')
 def insert_user(username, password, first_name, last_name, user_type="viewer"):
     """Inserts a new user into the database."""
     try:
         connection = get_db_connection()
         cursor = connection.cursor()
 
-        # Create users table if it doesn't exist
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL UNIQUE,
-            password_hash TEXT NOT NULL,
-            first_name TEXT NOT NULL,
-            last_name TEXT NOT NULL,
-            user_type TEXT CHECK(user_type IN ('admin', 'viewer')) NOT NULL DEFAULT 'viewer',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-
         query = """INSERT INTO users (username, password_hash, first_name, last_name, user_type) 
                    VALUES (?, ?, ?, ?, ?)"""
         cursor.execute(query, (username, password, first_name, last_name, user_type))
@@ -129,12 +289,13 @@ def insert_user(username, password, first_name, last_name, user_type="viewer"):
         close_db_connection(connection)
         return True
     except sqlite3.Error as err:
-        print("SQLite Error:", err)
+        _db_error('insert_user', err)
         connection.rollback()
         cursor.close()
         close_db_connection(connection)
         return False
 
+@timed('db_call_seconds')
 def get_all_users():
     """Retrieves all users from the database."""
     try:
@@ -146,132 +307,436 @@ def get_all_users():
         close_db_connection(connection)
         return [{"id": str(user["id"]), "username": user["username"], "first_name": user["first_name"], "last_name": user["last_name"], "user_type": user["user_type"]} for user in users]
     except sqlite3.Error as err:
-        print("SQLite Error:", err)
+        _db_error('get_all_users', err)
         cursor.close()
         close_db_connection(connection)
         return False
 
+@timed('db_call_seconds')
 def delete_user(id):
-    """Deletes a user from the database."""
+    """Deletes a user from the database, moving their records to archived_records."""
     try:
         connection = get_db_connection()
         cursor = connection.cursor()
+        cursor.execute(USER_DATASET_RECORDS_SQL, (id,))
+        cursor.executemany(ARCHIVE_RECORD_SQL, [tuple(record) for record in cursor.fetchall()])
         cursor.execute("DELETE FROM users WHERE id = ?", (id,))
+        cursor.execute(RELEASE_UNUSED_DATASETS_SQL)
+        # The user's records went with them; datasets no other record uses are archived
+        cursor.execute("SELECT uuid, form_type FROM datasets WHERE ref_count <= 0")
+        unused = [(row["uuid"], row["form_type"]) for row in cursor.fetchall()]
         connection.commit()
         cursor.close()
         close_db_connection(connection)
+        _archive_unused(unused)
         return True
     except sqlite3.Error as err:
-        print("SQLite Error:", err)
+        _db_error('delete_user', err)
         cursor.close()
         close_db_connection(connection)
         return False
     
-def insert_result_record(uuid, name, username, type):
-    """Inserts a record for a user."""
+@timed('db_call_seconds')
+def insert_result_record(uuid, name, username, type, content_hash=None, dataset_uuid=None):
+    """Inserts a record for a user.
+
+    A record computed from its own upload also registers its dataset under
+    content_hash, so identical uploads can reuse it. Pass dataset_uuid
+    instead to point the record at an existing dataset (see find_dataset);
+    this returns False if no record uses that dataset any more.
+    """
     try:
         connection = get_db_connection()
         cursor = connection.cursor()
 
-        # Create records table if it doesn't exist
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS records (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            uuid TEXT NOT NULL UNIQUE,
-            name TEXT NOT NULL,
-            username TEXT NOT NULL,
-            type TEXT CHECK(type IN ('ASSI-A', 'ASSI-C')) NOT NULL,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (username) REFERENCES users(username) ON DELETE CASCADE
-        )
-        """)
-
-        query = "INSERT INTO records (uuid, name, username, type) VALUES (?, ?, ?, ?)"
-        cursor.execute(query, (uuid, name, username, type))
+        if dataset_uuid is not None:
+            cursor.execute("SELECT 1 FROM datasets WHERE uuid = ? AND ref_count > 0", (dataset_uuid,))
+            if cursor.fetchone() is None:
+                # Its last record was deleted since find_dataset; the upload is computed afresh
+                cursor.close()
+                close_db_connection(connection)
+                return False
+            cursor.execute("INSERT INTO shared_records (uuid, dataset_uuid) VALUES (?, ?)", (uuid, dataset_uuid))
+        else:
+            if content_hash is not None and _dataset_for_hash(cursor, content_hash, type) is not None:
+                # An identical upload finished first; keep this copy, but out of the lookup
+                content_hash = None
+            cursor.execute("INSERT INTO datasets (uuid, form_type, content_hash) VALUES (?, ?, ?)", (uuid, type, content_hash))
+        cursor.execute(INSERT_RECORD_SQL, (uuid, name, username, type))
         connection.commit()
         cursor.close()
         close_db_connection(connection)
         return True
     except sqlite3.Error as err:
-        print("SQLite Error:", err)
+        _db_error('insert_result_record', err)
         connection.rollback()
         cursor.close()
         close_db_connection(connection)
         return False
 
+def _dataset_for_hash(cursor, content_hash, form_type):
+    cursor.execute("SELECT uuid FROM datasets WHERE content_hash = ? AND form_type = ? AND ref_count > 0", (content_hash, form_type))
+    row = cursor.fetchone()
+    return row["uuid"] if row else None
+
+@timed('db_call_seconds')
+def find_dataset(content_hash, form_type):
+    """Returns the uuid of a dataset computed from an upload with this content hash, or None."""
+    try:
+        connection = get_db_connection()
+        cursor = connection.cursor()
+        dataset_uuid = _dataset_for_hash(cursor, content_hash, form_type)
+        cursor.close()
+        close_db_connection(connection)
+        return dataset_uuid
+    except sqlite3.Error as err:
+        _db_error('find_dataset', err)
+        close_db_connection(connection)
+        return None
+
+def resolve_dataset(uuid):
+    """Returns the uuid the files of record uuid are stored under: its own, or the dataset it shares."""
+    try:
+        connection = get_db_connection()
+        cursor = connection.cursor()
+        cursor.execute(RESOLVE_DATASET_SQL, (uuid,))
+        row = cursor.fetchone()
+        cursor.close()
+        close_db_connection(connection)
+        return row["dataset_uuid"] if row else uuid
+    except sqlite3.Error as err:
+        _db_error('resolve_dataset', err)
+        close_db_connection(connection)
+        return uuid
+
+@timed('db_call_seconds')
+def get_form_datasets(form_type):
+    """Returns {dataset uuid: record uuid} for every dataset of a form type, naming one record that uses it."""
+    try:
+        connection = get_db_connection()
+        cursor = connection.cursor()
+        cursor.execute(FORM_DATASETS_SQL, (form_type,))
+        datasets = {row["dataset_uuid"]: row["owner"] or row["uuid"] for row in cursor.fetchall()}
+        cursor.close()
+        close_db_connection(connection)
+        return datasets
+    except sqlite3.Error as err:
+        _db_error('get_form_datasets', err)
+        close_db_connection(connection)
+        return {}
+
+@timed('db_call_seconds')
 def get_user_records(username):
     """Retrieves all records associated with a specific username."""
     try:
         connection = get_db_connection()
         cursor = connection.cursor()
-        cursor.execute("SELECT * FROM records WHERE username = ?", (username,))
+        cursor.execute(USER_RECORDS_SQL, (username,))
         records = cursor.fetchall()
-        print(records)
         cursor.close()
         close_db_connection(connection)
         return [dict(record) for record in records]  # Convert rows to dict
     except sqlite3.Error as err:
-        print("SQLite Error:", err)
+        _db_error('get_user_records', err)
         cursor.close()
         close_db_connection(connection)
         return False
     
+@timed('db_call_seconds')
 def delete_record(uuid):
+    """Moves a record to archived_records; the files of its dataset are archived once no other record uses them."""
     try:
+        dataset_uuid = resolve_dataset(uuid)
         connection = get_db_connection()
         cursor = connection.cursor()
-        # Create archived records table if it doesn't exist
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS archived_records (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            uuid TEXT NOT NULL UNIQUE,
-            name TEXT NOT NULL,
-            username TEXT NOT NULL,
-            type TEXT CHECK(type IN ('ASSI-A', 'ASSI-C')) NOT NULL,
-            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (username) REFERENCES users(username) ON DELETE CASCADE
-        )
-        """)
-        cursor.execute("DELETE FROM records WHERE uuid = ?", (uuid,))
+        cursor.execute("SELECT * FROM records WHERE uuid = ?", (uuid,))
+        record = cursor.fetchone()
+        if record is None:
+            cursor.close()
+            close_db_connection(connection)
+            return True
+        form_type = record["type"]
+
+        with dataset_lock(dataset_uuid, form_type):
+            cursor.execute(ARCHIVE_RECORD_SQL, (uuid, record["name"], record["username"], form_type, dataset_uuid))
+            cursor.execute("DELETE FROM records WHERE uuid = ?", (uuid,))
+            cursor.execute(RELEASE_UNUSED_DATASETS_SQL)
+            cursor.execute("SELECT ref_count FROM datasets WHERE uuid = ?", (dataset_uuid,))
+            dataset = cursor.fetchone()
+            # Datasets processed before reference counting have no row, and no other record either
+            unused = dataset is None or dataset["ref_count"] <= 0
+            connection.commit()
+            cursor.close()
+            close_db_connection(connection)
+
+        if unused:
+            _archive_unused([(dataset_uuid, form_type)])
+        return True
+    except sqlite3.Error as err:
+        _db_error('delete_record', err)
+        close_db_connection(connection)
+        return False
+
+def _archive_unused(datasets):
+    # archive imports this module, so it is imported here
+    from src.archive import schedule_archive
+
+    for dataset_uuid, form_type in datasets:
+        schedule_archive(dataset_uuid, form_type)
+
+@timed('db_call_seconds')
+def drop_dataset(uuid, form_type):
+    """Deletes the rows of a dataset no record uses any more (its registration and pending overrides)."""
+    try:
+        connection = get_db_connection()
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM datasets WHERE uuid = ? AND ref_count <= 0", (uuid,))
+        cursor.execute("DELETE FROM cluster_overrides WHERE uuid = ? AND form_type = ?", (uuid, form_type))
         connection.commit()
         cursor.close()
         close_db_connection(connection)
-        
         return True
     except sqlite3.Error as err:
-        print("SQLite Error:", err)
+        _db_error('drop_dataset', err)
+        close_db_connection(connection)
+        return False
+
+@timed('db_call_seconds')
+def get_dataset_users():
+    """Returns {(form_type, dataset uuid): username} for every dataset in use, by the user of the record owning it."""
+    try:
+        connection = get_db_connection()
+        cursor = connection.cursor()
+        cursor.execute(DATASET_USERS_SQL)
+        users = {}
+        for row in cursor.fetchall():
+            users.setdefault((row["type"], row["dataset_uuid"]), row["username"])
+        cursor.close()
+        close_db_connection(connection)
+        return users
+    except sqlite3.Error as err:
+        _db_error('get_dataset_users', err)
+        close_db_connection(connection)
+        return {}
+
+@timed('db_call_seconds')
+def get_archived_records(dataset_uuid=None):
+    """Returns the archived records, optionally only those that used dataset_uuid, oldest first."""
+    try:
+        connection = get_db_connection()
+        cursor = connection.cursor()
+        if dataset_uuid is None:
+            cursor.execute("SELECT * FROM archived_records ORDER BY id")
+        else:
+            cursor.execute("SELECT * FROM archived_records WHERE dataset_uuid = ? ORDER BY id", (dataset_uuid,))
+        records = [dict(record) for record in cursor.fetchall()]
         cursor.close()
         close_db_connection(connection)
+        return records
+    except sqlite3.Error as err:
+        _db_error('get_archived_records', err)
+        close_db_connection(connection)
+        return []
+
+@timed('storage_call_seconds')
+def detach_dataset(uuid, form_type):
+    """Gives record uuid sole use of its files under its own uuid, before they are modified.
+
+    A record sharing another upload's dataset gets a copy of it (copy on
+    write); when other records share this record's own dataset, they move to
+    a copy instead. Either way the dataset stops matching new uploads, since
+    its content is about to diverge. Returns True, or False on failure.
+    """
+    try:
+        dataset_uuid = resolve_dataset(uuid)
+        with dataset_lock(dataset_uuid, form_type):
+            connection = get_db_connection()
+            cursor = connection.cursor()
+            cursor.execute("SELECT content_hash, ref_count FROM datasets WHERE uuid = ?", (dataset_uuid,))
+            dataset = cursor.fetchone()
+            if dataset is None or dataset["ref_count"] <= 1:
+                cursor.execute("UPDATE datasets SET content_hash = NULL WHERE uuid = ?", (dataset_uuid,))
+                connection.commit()
+                cursor.close()
+                close_db_connection(connection)
+                return True
+
+            # The copy serves whoever leaves; the files under uuid stay with this record
+            copy_uuid = uuid if dataset_uuid != uuid else str(uuid4())
+            copy_dataset(dataset_uuid, copy_uuid, form_type)
+            cursor.execute(
+                "INSERT INTO cluster_overrides (uuid, form_type, name, row_offset, cluster, created_at) "
+                "SELECT ?, form_type, name, row_offset, cluster, created_at FROM cluster_overrides WHERE uuid = ? AND form_type = ? ORDER BY id",
+                (copy_uuid, dataset_uuid, form_type))
+            if dataset_uuid != uuid:
+                cursor.execute("DELETE FROM shared_records WHERE uuid = ?", (uuid,))
+                cursor.execute("UPDATE datasets SET ref_count = ref_count - 1 WHERE uuid = ?", (dataset_uuid,))
+                cursor.execute("INSERT INTO datasets (uuid, form_type, ref_count) VALUES (?, ?, 1)", (uuid, form_type))
+            else:
+                cursor.execute("UPDATE shared_records SET dataset_uuid = ? WHERE dataset_uuid = ?", (copy_uuid, uuid))
+                cursor.execute("UPDATE datasets SET content_hash = NULL, ref_count = 1 WHERE uuid = ?", (uuid,))
+                cursor.execute("INSERT INTO datasets (uuid, form_type, content_hash, ref_count) VALUES (?, ?, ?, ?)",
+                               (copy_uuid, form_type, dataset["content_hash"], dataset["ref_count"] - 1))
+            connection.commit()
+            cursor.close()
+            close_db_connection(connection)
+        return True
+    except (sqlite3.Error, OSError) as err:
+        _db_error('detach_dataset', err)
+        close_db_connection(connection)
         return False
 
-def get_student_data_by_uuid_and_name(uuid, name, form_type):
+@timed('storage_call_seconds')
+def get_student_data_by_uuid_and_name(uuid, name, form_type, occurrence=0):
     try:
-        df = pd.read_csv(f'student_data/{form_type}/{uuid}.csv')
-        df['Name'] = df['Name'].astype(str)
-        print(df['Name'].head())
-        df = df[df['Name'] == name]
-        print(len(df))
-        print(df.head())
+        # Students sharing a name are told apart by occurrence, in upload row order
+        # The index and the row must come from the same version of the dataset
+        with dataset_lock(uuid, form_type, shared=True):
+            offsets = lookup_student(uuid, form_type, name)
+            if occurrence >= len(offsets):
+                logger.debug("Student not found: %s", name)
+                return False
+            df = read_student_row(uuid, form_type, offsets[occurrence])
+        row = decode_student_record(df, form_type)
         student_data = {
             'Name': name,
-            'Grade': int(df['Grade'].iloc[0]) if not df['Grade'].empty else None,
-            'Gender': df['Gender'].iloc[0] if not df['Gender'].empty else None,
-            'Cluster': int(df['Cluster'].iloc[0]) if not df['Cluster'].empty else None,
-            'Questions': {col: int(df[col].iloc[0]) if isinstance(df[col].iloc[0], np.int64) else df[col].iloc[0] 
-                         for col in df.columns if col not in ['Name', 'Grade', 'Gender', 'Cluster']}
+            'Grade': int(row['Grade']) if row['Grade'] is not None else None,
+            'Gender': row['Gender'],
+            'Cluster': int(row['Cluster']) if row['Cluster'] is not None else None,
+            'Occurrences': len(offsets),
+            'Questions': {col: row[col] for col in answer_columns(df.columns)}
         }
         return student_data
     except Exception as e:
-        print("Error:", e)
+        _db_error('get_student_data_by_uuid_and_name', e)
         return False
 
-def update_student_cluster(uuid,name,cluster,form_type):
+@timed('db_call_seconds')
+def get_cluster_overrides(uuid, form_type):
+    """Returns the pending (id, name, row offset, cluster) overrides of a dataset in the order they were made."""
     try:
-        df = pd.read_csv(f'student_data/{form_type}/{uuid}.csv')
-        df['Name'] = df['Name'].astype(str)
-        df.loc[df['Name'] == name, 'Cluster'] = int(cluster)
-        df.to_csv(f'student_data/{form_type}/{uuid}.csv', index=False)
+        connection = get_db_connection()
+        cursor = connection.cursor()
+        cursor.execute("SELECT id, name, row_offset, cluster FROM cluster_overrides WHERE uuid = ? AND form_type = ? ORDER BY id", (uuid, form_type))
+        overrides = [(row["id"], row["name"], row["row_offset"], row["cluster"]) for row in cursor.fetchall()]
+        cursor.close()
+        close_db_connection(connection)
+        return overrides
+    except sqlite3.Error as err:
+        _db_error('get_cluster_overrides', err)
+        close_db_connection(connection)
+        return []
+
+@timed('storage_call_seconds')
+def update_student_clusters(uuid, changes, form_type):
+    """Reassigns many students at once by appending (name, cluster, occurrence) changes to the override log.
+
+    occurrence picks one of the students sharing a name, in upload row order
+    as in get_student_data_by_uuid_and_name, and may be left out for the
+    first. Returns the names that are not in the dataset (those changes are
+    skipped), or False on failure. Later changes for the same student win.
+    """
+    try:
+        with dataset_lock(uuid, form_type):
+            latest = {}
+            unknown = []
+            for name, cluster, *occurrence in changes:
+                name = str(name)
+                offsets = lookup_student(uuid, form_type, name)
+                occurrence = int(occurrence[0]) if occurrence else 0
+                if 0 <= occurrence < len(offsets):
+                    latest[offsets[occurrence]] = (name, int(cluster))
+                else:
+                    unknown.append(name)
+            if not latest:
+                return unknown
+
+            df = load_student_data(uuid, form_type)
+            connection = get_db_connection()
+            cursor = connection.cursor()
+            cursor.executemany(
+                "INSERT INTO cluster_overrides (uuid, form_type, name, row_offset, cluster) VALUES (?, ?, ?, ?, ?)",
+                [(uuid, form_type, name, offset, cluster) for offset, (name, cluster) in latest.items()]
+            )
+            connection.commit()
+            cursor.execute("SELECT COUNT(*) FROM cluster_overrides WHERE uuid = ? AND form_type = ?", (uuid, form_type))
+            pending = cursor.fetchone()[0]
+            cursor.close()
+            close_db_connection(connection)
+
+            # The cached frame is rebuilt with the overrides merged on the next read
+            cache_invalidate((form_type, uuid))
+            for cluster in {cluster for _, cluster in latest.values()}:
+                offsets = [offset for offset, (_, c) in latest.items() if c == cluster]
+                move_students_in_cube(uuid, form_type, df.iloc[offsets], cluster)
+
+        if pending >= COMPACT_OVERRIDES_AT:
+            _compaction_executor.submit(compact_cluster_overrides, uuid, form_type)
+        return unknown
+    except Exception as e:
+        _db_error('update_student_clusters', e)
+        return False
+
+@timed('storage_call_seconds')
+def compact_cluster_overrides(uuid, form_type):
+    """Folds the pending overrides of a dataset into its student data file and trims the log."""
+    try:
+        with dataset_lock(uuid, form_type):
+            overrides = get_cluster_overrides(uuid, form_type)
+            if not overrides:
+                return True
+            cache_invalidate((form_type, uuid))
+            df = load_student_data(uuid, form_type)
+            save_student_data(df, uuid, form_type)
+
+            connection = get_db_connection()
+            cursor = connection.cursor()
+            cursor.execute("DELETE FROM cluster_overrides WHERE uuid = ? AND form_type = ? AND id <= ?", (uuid, form_type, overrides[-1][0]))
+            connection.commit()
+            cursor.close()
+            close_db_connection(connection)
+            logger.info("Compacted %d cluster overrides into %s/%s", len(overrides), form_type, uuid)
+            return True
+    except Exception as e:
+        _db_error('compact_cluster_overrides', e)
+        return False
+
+@timed('storage_call_seconds')
+def append_students(uuid, form_type, df):
+    """Appends clustered new rows to a dataset and its answer cube under the dataset lock.
+
+    The rewritten file already holds the pending cluster overrides, so the
+    log is emptied with it and older overrides by name cannot reach the new
+    rows.
+    """
+    try:
+        with dataset_lock(uuid, form_type):
+            rows = append_student_data(df, uuid, form_type)
+            add_students_to_cube(uuid, form_type, rows)
+            clear_cluster_overrides(uuid, form_type)
         return True
     except Exception as e:
-        print("Error:", e)
+        _db_error('append_students', e)
+        return False
+
+@timed('db_call_seconds')
+def clear_cluster_overrides(uuid, form_type):
+    """Drops every pending override of a dataset, e.g. after a re-fit renumbered its clusters."""
+    try:
+        connection = get_db_connection()
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM cluster_overrides WHERE uuid = ? AND form_type = ?", (uuid, form_type))
+        connection.commit()
+        cursor.close()
+        close_db_connection(connection)
+        return True
+    except sqlite3.Error as err:
+        _db_error('clear_cluster_overrides', err)
+        close_db_connection(connection)
+        return False
+
+def update_student_cluster(uuid,name,cluster,form_type,occurrence=0):
+    unknown = update_student_clusters(uuid, [(name, cluster, occurrence)], form_type)
+    if unknown is False:
         return False
+    return True
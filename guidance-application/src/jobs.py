@@ -0,0 +1,260 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from src.metrics import observe, inc
+from src.concurrency import atomic_path, remove_scratch_dir
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+# Finished jobs are kept around this long (seconds) so clients can still poll them
+JOB_TTL = int(os.environ.get("JOB_TTL", 3600))
+# Every job is mirrored here so any worker process can answer a poll
+JOBS_FOLDER = 'jobs'
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="pipeline")
+_jobs = {}
+_jobs_lock = threading.Lock()
+# Tells this process from an earlier one that had the same pid, e.g. pid 1 of a restarted container
+_process_token = uuid4().hex
+
+logger = logging.getLogger(__name__)
+
+
+def _job_path(job_id):
+    return os.path.join(JOBS_FOLDER, f'{job_id}.json')
+
+
+def _persist(job):
+    # Called with _jobs_lock held, so snapshots reach the file in order
+    try:
+        with atomic_path(_job_path(job['id'])) as tmp_path, open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(job, f)
+    except (OSError, TypeError, ValueError) as e:
+        logger.error("Could not save the state of job %s: %s", job['id'], e)
+
+
+def _prune_finished_jobs():
+    now = time.time()
+    expired = [job_id for job_id, job in _jobs.items()
+               if job['status'] in ('completed', 'failed') and now - job['updated_at'] > JOB_TTL]
+    for job_id in expired:
+        del _jobs[job_id]
+        if os.path.exists(_job_path(job_id)):
+            os.remove(_job_path(job_id))
+
+
+def _owner_alive(job):
+    pid = job.get('pid')
+    if pid is None:
+        return False
+    if pid == os.getpid():
+        return job.get('process') == _process_token
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def fail_interrupted_jobs():
+    """Marks saved queued or running jobs whose worker process is gone as failed.
+
+    Their state would otherwise never change, so clients would poll them
+    forever and sweep_saved_jobs would never delete them. Returns their ids.
+    """
+    interrupted = []
+    if not os.path.isdir(JOBS_FOLDER):
+        return interrupted
+    for file_name in os.listdir(JOBS_FOLDER):
+        if file_name.startswith('.') or not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(JOBS_FOLDER, file_name), 'r', encoding='utf-8') as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if job['status'] not in ('queued', 'running') or job['id'] in _jobs or _owner_alive(job):
+            continue
+        job['status'] = 'failed'
+        job['message'] = 'Interrupted: the worker process stopped before the job finished'
+        job['updated_at'] = time.time()
+        with _jobs_lock:
+            _persist(job)
+        logger.warning("Job %s was interrupted by a stopped worker process", job['id'])
+        interrupted.append(job['id'])
+    return interrupted
+
+
+def sweep_saved_jobs():
+    """Deletes saved jobs that finished over JOB_TTL ago, also those of other or stopped worker processes.
+
+    Jobs left queued or running by a stopped worker process are failed
+    first, see fail_interrupted_jobs. Returns the saved state of the
+    remaining jobs.
+    """
+    fail_interrupted_jobs()
+    now = time.time()
+    remaining = []
+    if not os.path.isdir(JOBS_FOLDER):
+        return remaining
+    for file_name in os.listdir(JOBS_FOLDER):
+        if file_name.startswith('.') or not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(JOBS_FOLDER, file_name), 'r', encoding='utf-8') as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if job['status'] in ('completed', 'failed') and now - job['updated_at'] > JOB_TTL:
+            with _jobs_lock:
+                _jobs.pop(job['id'], None)
+                if os.path.exists(_job_path(job['id'])):
+                    os.remove(_job_path(job['id']))
+        else:
+            remaining.append(job)
+    return remaining
+
+
+def create_job(stages, **metadata):
+    """Registers a new queued job with the given ordered stage names and returns its id."""
+    job_id = str(uuid4())
+    now = time.time()
+    job = {
+        'id': job_id,
+        'status': 'queued',
+        'stage': None,
+        'stages': [{'name': name, 'status': 'pending', 'elapsed': None} for name in stages],
+        'progress': 0.0,
+        'results': None,
+        'message': None,
+        'created_at': now,
+        'updated_at': now,
+        'pid': os.getpid(),
+        'process': _process_token,
+        **metadata
+    }
+    with _jobs_lock:
+        _prune_finished_jobs()
+        _jobs[job_id] = job
+        _persist(job)
+    return job_id
+
+
+def get_job(job_id):
+    """Returns a snapshot of the job, or None if it does not exist.
+
+    Jobs run by another worker process are read from their saved state.
+    """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is not None:
+            snapshot = dict(job)
+            snapshot['stages'] = [dict(s) for s in job['stages']]
+            return snapshot
+    try:
+        with open(_job_path(os.path.basename(job_id)), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _update_stage(job_id, name, status, elapsed=None):
+    with _jobs_lock:
+        job = _jobs[job_id]
+        for s in job['stages']:
+            if s['name'] == name:
+                s['status'] = status
+                if elapsed is not None:
+                    s['elapsed'] = round(elapsed, 3)
+        if status == 'running':
+            job['status'] = 'running'
+            job['stage'] = name
+        done = sum(1 for s in job['stages'] if s['status'] == 'completed')
+        job['progress'] = round(done / len(job['stages']), 3) if job['stages'] else 1.0
+        job['updated_at'] = time.time()
+        _persist(job)
+
+
+@contextmanager
+def stage(job_id, name):
+    """Marks a stage as running for the duration of the block and records its wall time."""
+    _update_stage(job_id, name, 'running')
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        elapsed = time.perf_counter() - start
+        _update_stage(job_id, name, 'failed', elapsed)
+        observe('pipeline_stage_seconds', elapsed, stage=name, status='failed')
+        raise
+    elapsed = time.perf_counter() - start
+    _update_stage(job_id, name, 'completed', elapsed)
+    observe('pipeline_stage_seconds', elapsed, stage=name, status='completed')
+    logger.debug("Job %s: stage %s took %.3fs", job_id, name, elapsed)
+
+
+def set_pending_stages(job_id, stages):
+    """Replaces the stages a job has not started yet, for jobs that only learn while running which work remains."""
+    with _jobs_lock:
+        job = _jobs[job_id]
+        job['stages'] = [s for s in job['stages'] if s['status'] != 'pending']
+        job['stages'] += [{'name': name, 'status': 'pending', 'elapsed': None} for name in stages]
+        done = sum(1 for s in job['stages'] if s['status'] == 'completed')
+        job['progress'] = round(done / len(job['stages']), 3)
+        job['updated_at'] = time.time()
+        _persist(job)
+
+
+def complete_job(job_id, results):
+    with _jobs_lock:
+        job = _jobs[job_id]
+        job['status'] = 'completed'
+        job['stage'] = None
+        job['progress'] = 1.0
+        job['results'] = results
+        job['updated_at'] = time.time()
+        _persist(job)
+
+
+def fail_job(job_id, message):
+    with _jobs_lock:
+        job = _jobs[job_id]
+        job['status'] = 'failed'
+        job['message'] = message
+        job['updated_at'] = time.time()
+        _persist(job)
+
+
+def submit_job(job_id, fn, *args, **kwargs):
+    """Runs fn(job_id, *args, **kwargs) on the background pool.
+
+    fn returns the results payload on success; any exception it raises marks
+    the job as failed with the exception message. The job's scratch folder
+    is removed once it ends either way.
+    """
+    def run():
+        start = time.perf_counter()
+        try:
+            results = fn(job_id, *args, **kwargs)
+        except Exception as e:
+            logger.exception("Job %s (%s) failed", job_id, fn.__name__)
+            observe('pipeline_job_seconds', time.perf_counter() - start, pipeline=fn.__name__, status='failed')
+            inc('pipeline_jobs_total', pipeline=fn.__name__, status='failed')
+            fail_job(job_id, str(e))
+            return
+        finally:
+            remove_scratch_dir(job_id)
+        elapsed = time.perf_counter() - start
+        observe('pipeline_job_seconds', elapsed, pipeline=fn.__name__, status='completed')
+        inc('pipeline_jobs_total', pipeline=fn.__name__, status='completed')
+        logger.info("Job %s (%s) completed in %.3fs", job_id, fn.__name__, elapsed)
+        complete_job(job_id, results)
+
+    return _executor.submit(run)
@@ -0,0 +1,145 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from src.cache import cache_stats
+
+# Upper bounds (seconds) of the histogram buckets for requests, DB and storage calls
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Pipeline stages run from milliseconds to many minutes on district-scale uploads
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+HISTOGRAM_BUCKETS = {
+    'pipeline_stage_seconds': STAGE_BUCKETS,
+    'pipeline_job_seconds': STAGE_BUCKETS,
+}
+
+METRIC_HELP = {
+    'http_request_seconds': 'Time spent handling an HTTP request',
+    'pipeline_stage_seconds': 'Wall time of a pipeline job stage',
+    'pipeline_job_seconds': 'Wall time of a whole pipeline job',
+    'pipeline_jobs_total': 'Pipeline jobs finished, by outcome',
+    'db_call_seconds': 'Time spent in a database call',
+    'storage_call_seconds': 'Time spent in a db module call that mostly reads or writes dataset files',
+    'db_errors_total': 'Database calls that failed',
+    'rows_processed_total': 'Student rows processed, by pipeline step',
+    'gc_archived_datasets_total': 'Datasets no record uses any more, moved to the archive',
+    'gc_reclaimed_bytes_total': 'Disk space freed by archiving and garbage collection, by kind of file',
+}
+
+_histograms = {}  # name -> {labels: [bucket counts..., sum, count]}
+_counters = {}  # name -> {labels: value}
+_lock = threading.Lock()
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def observe(name, value, **labels):
+    """Records one observation of a histogram, e.g. a duration in seconds."""
+    buckets = HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS)
+    key = _label_key(labels)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        counts = series.get(key)
+        if counts is None:
+            counts = series[key] = [0] * (len(buckets) + 2)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-2] += value
+        counts[-1] += 1
+
+
+def inc(name, amount=1, **labels):
+    """Adds amount to a counter."""
+    key = _label_key(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observes the wall time of the block into histogram name, also when it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name, **labels):
+    """Decorator form of timer; the function name is added as the 'call' label."""
+    def decorator(fn):
+        call_labels = dict(labels, call=fn.__name__)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name, **call_labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _render_cache(lines):
+    stats = cache_stats()
+    for name, kind, help_text, value in [
+        ('dataset_cache_hits_total', 'counter', 'Dataset cache lookups that hit', stats['hits']),
+        ('dataset_cache_misses_total', 'counter', 'Dataset cache lookups that missed', stats['misses']),
+        ('dataset_cache_evictions_total', 'counter', 'Entries evicted from the dataset cache', stats['evictions']),
+        ('dataset_cache_bytes', 'gauge', 'Estimated bytes held by the dataset cache', stats['bytes']),
+        ('dataset_cache_entries', 'gauge', 'Entries in the dataset cache', stats['entries']),
+    ]:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {value}']
+
+    lines += ['# HELP dataset_cache_hit_ratio Share of dataset cache lookups that hit, by kind of entry',
+              '# TYPE dataset_cache_hit_ratio gauge']
+    if stats['hit_ratio'] is not None:
+        lines.append(f'dataset_cache_hit_ratio{{kind="all"}} {stats["hit_ratio"]}')
+    for kind, kind_stats in sorted(stats['by_kind'].items()):
+        if kind_stats['hit_ratio'] is not None:
+            lines.append(f'dataset_cache_hit_ratio{{kind="{kind}"}} {kind_stats["hit_ratio"]}')
+
+
+def render_metrics():
+    """Returns all metrics of this process in the Prometheus text exposition format."""
+    with _lock:
+        histograms = {name: {key: list(counts) for key, counts in series.items()} for name, series in _histograms.items()}
+        counters = {name: dict(series) for name, series in _counters.items()}
+
+    lines = []
+    for name in sorted(counters):
+        lines += [f'# HELP {name} {METRIC_HELP.get(name, name)}', f'# TYPE {name} counter']
+        for key, value in sorted(counters[name].items()):
+            lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+
+    for name in sorted(histograms):
+        buckets = HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS)
+        lines += [f'# HELP {name} {METRIC_HELP.get(name, name)}', f'# TYPE {name} histogram']
+        for key, counts in sorted(histograms[name].items()):
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(key, [("le", _format_value(float(bound)))])} {cumulative}')
+            lines.append(f'{name}_bucket{_format_labels(key, [("le", "+Inf")])} {counts[-1]}')
+            lines.append(f'{name}_sum{_format_labels(key)} {_format_value(counts[-2])}')
+            lines.append(f'{name}_count{_format_labels(key)} {counts[-1]}')
+
+    _render_cache(lines)
+    return '\n'.join(lines) + '\n'
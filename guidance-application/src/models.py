@@ -0,0 +1,197 @@
+import copy
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+from src.cache import cache_get, cache_put, cache_invalidate
+from src.concurrency import atomic_path, dataset_lock
+from src.schemas import check_header
+from src.storage import encode_features
+from src.metrics import inc
+
+MODELS_FOLDER = 'models'
+
+
+def model_dir(uuid, form_type):
+    return os.path.join(MODELS_FOLDER, form_type, uuid)
+
+
+def save_pipeline(fitted, uuid, form_type, classifier=None, classifier_dir=None):
+    """Stores the fitted scaler, PCA projection and KMeans model of a dataset with joblib.
+
+    classifier is the summary returned by run_model_selection, whose files
+    were saved into classifier_dir (e.g. the job's scratch folder); they are
+    moved next to the pipeline and replace the previous models as one
+    update under the dataset lock.
+    """
+    pipeline = {
+        'form_type': form_type,
+        'feature_columns': fitted['feature_columns'],
+        'scaler': fitted['scaler'],
+        'pca_mean': fitted['pca_mean'],
+        'pca_components': fitted['pca_components'],
+        'kmeans': fitted['kmeans'],
+        'classifier': None,
+    }
+    if classifier and classifier.get('model_file'):
+        pipeline['classifier'] = {'model_name': classifier['model_name'], 'model_file': classifier['model_file']}
+
+    directory = model_dir(uuid, form_type)
+    kept = {'pipeline.joblib'}
+    with dataset_lock(uuid, form_type):
+        os.makedirs(directory, exist_ok=True)
+        if pipeline['classifier'] and classifier_dir:
+            kept.update([pipeline['classifier']['model_file'], 'scaler.joblib'])
+            for file_name in kept - {'pipeline.joblib'}:
+                os.replace(os.path.join(classifier_dir, file_name), os.path.join(directory, file_name))
+        file_path = write_pipeline(pipeline, uuid, form_type)
+        # Models of an earlier fit, e.g. a classifier that lost this time
+        for file_name in os.listdir(directory):
+            stale = os.path.join(directory, file_name)
+            if file_name in kept or file_name.startswith('.'):
+                continue
+            if os.path.isdir(stale):
+                shutil.rmtree(stale)
+            else:
+                os.remove(stale)
+        cache_invalidate((form_type, uuid, 'classifier'))
+    return file_path
+
+
+def write_pipeline(pipeline, uuid, form_type):
+    import joblib
+
+    file_path = os.path.join(model_dir(uuid, form_type), 'pipeline.joblib')
+    with dataset_lock(uuid, form_type):
+        with atomic_path(file_path) as tmp_path:
+            joblib.dump(pipeline, tmp_path)
+        cache_put((form_type, uuid, 'pipeline'), pipeline)
+    return file_path
+
+
+def load_pipeline(uuid, form_type):
+    """Returns the stored pipeline of a dataset, or None if it was processed before pipelines were saved."""
+    import joblib
+
+    cached = cache_get((form_type, uuid, 'pipeline'))
+    if cached is not None:
+        return cached
+    file_path = os.path.join(model_dir(uuid, form_type), 'pipeline.joblib')
+    with dataset_lock(uuid, form_type, shared=True):
+        if not os.path.exists(file_path):
+            return None
+        return cache_put((form_type, uuid, 'pipeline'), joblib.load(file_path))
+
+
+def _load_classifier(pipeline, uuid, form_type):
+    import joblib
+
+    cached = cache_get((form_type, uuid, 'classifier'))
+    if cached is not None:
+        return cached
+    directory = model_dir(uuid, form_type)
+    model_file = pipeline['classifier']['model_file']
+    with dataset_lock(uuid, form_type, shared=True):
+        if model_file.endswith('.keras'):
+            # Loads TensorFlow into this process; safe for later fits only because
+            # run_model_selection spawns its workers instead of forking them
+            from tensorflow.keras.models import load_model
+            model = load_model(os.path.join(directory, model_file))
+        else:
+            model = joblib.load(os.path.join(directory, model_file))
+        return cache_put((form_type, uuid, 'classifier'), (joblib.load(os.path.join(directory, 'scaler.joblib')), model))
+
+
+def project_batch(df, pipeline):
+    """Returns the mask of fully answered rows of df and their projection onto the stored PCA components."""
+    # Encoded as in load_data_and_preprocess
+    features = encode_features(df[pipeline['feature_columns']], pipeline['form_type'])
+    valid = features.notna().all(axis=1).to_numpy()
+    if not valid.any():
+        return valid, np.empty((0, pipeline['pca_components'].shape[0]))
+    X = pipeline['scaler'].transform(features[valid])
+    return valid, (X - pipeline['pca_mean']) @ pipeline['pca_components'].T
+
+
+def predict_clusters(uuid, form_type, df, use_classifier=False):
+    """Assigns clusters to a batch of new responses with the stored models, without refitting.
+
+    df must have the upload columns of form_type. Returns a list of
+    {'Name', 'Cluster'} dicts in input order (Cluster is None for rows with
+    missing or unknown answers), or None if the dataset has no stored
+    pipeline. With use_classifier the stored best classifier assigns the
+    clusters instead of the KMeans centroids.
+    """
+    pipeline = load_pipeline(uuid, form_type)
+    if pipeline is None:
+        return None
+    df = df.copy()
+    df.columns = check_header(df.columns, form_type)
+
+    valid, components = project_batch(df, pipeline)
+    clusters = np.full(len(df), None, dtype=object)
+    if valid.any():
+        if use_classifier and pipeline['classifier']:
+            scaler, model = _load_classifier(pipeline, uuid, form_type)
+            X_classifier = scaler.transform(pd.DataFrame(components))
+            if not pipeline['classifier']['model_file'].endswith('.keras'):
+                predicted = model.predict(X_classifier)
+            else:
+                probabilities = model.predict(X_classifier, verbose=0)
+                predicted = np.argmax(probabilities, axis=1) if probabilities.shape[1] > 1 else (probabilities > 0.5).astype(int).flatten()
+        else:
+            predicted = pipeline['kmeans'].predict(components)
+        clusters[valid] = [int(cluster) for cluster in predicted]
+    inc('rows_processed_total', len(df), step='predict')
+
+    return [
+        {'Name': str(name), 'Cluster': cluster}
+        for name, cluster in zip(df['Name'].tolist(), clusters.tolist())
+    ]
+
+
+def assign_appended_rows(uuid, form_type, df):
+    """Assigns clusters to rows appended to a dataset and folds them into the stored centroids.
+
+    Each centroid moves to the running mean of its members (the MiniBatchKMeans
+    update), so the stored model follows the growing dataset without a re-fit.
+    Returns (clusters, drift, updated pipeline), or None if the dataset has no
+    stored pipeline. clusters holds None for rows with missing answers. drift
+    is how much worse all rows appended since the last fit match their
+    centroid than the fitted rows did, as a ratio of mean squared distances
+    minus one. The updated pipeline is saved with write_pipeline.
+    """
+    pipeline = load_pipeline(uuid, form_type)
+    if pipeline is None:
+        return None
+    # The loaded pipeline is shared through the cache
+    pipeline = dict(pipeline, kmeans=copy.deepcopy(pipeline['kmeans']))
+    kmeans = pipeline['kmeans']
+    if 'cluster_sizes' not in pipeline:
+        pipeline['cluster_sizes'] = np.bincount(kmeans.labels_, minlength=kmeans.n_clusters)
+        pipeline['baseline_distance'] = kmeans.inertia_ / len(kmeans.labels_)
+        pipeline['appended_rows'] = 0
+        pipeline['appended_distance'] = 0.0
+    sizes = pipeline['cluster_sizes'].copy()
+
+    valid, components = project_batch(df, pipeline)
+    clusters = np.full(len(df), None, dtype=object)
+    if valid.any():
+        labels = kmeans.predict(components)
+        distances = ((components - kmeans.cluster_centers_[labels]) ** 2).sum(axis=1)
+        centers = kmeans.cluster_centers_.copy()
+        for cluster in np.unique(labels):
+            members = components[labels == cluster]
+            centers[cluster] = (centers[cluster] * sizes[cluster] + members.sum(axis=0)) / (sizes[cluster] + len(members))
+            sizes[cluster] += len(members)
+        kmeans.cluster_centers_ = centers
+        pipeline['appended_rows'] += len(labels)
+        pipeline['appended_distance'] += float(distances.sum())
+        clusters[valid] = [int(cluster) for cluster in labels]
+    pipeline['cluster_sizes'] = sizes
+
+    drift = 0.0
+    if pipeline['appended_rows'] and pipeline['baseline_distance'] > 0:
+        drift = pipeline['appended_distance'] / pipeline['appended_rows'] / pipeline['baseline_distance'] - 1
+    return clusters.tolist(), drift, pipeline
@@ -0,0 +1,129 @@
+import os
+import numpy as np
+import pandas as pd
+
+from src.cache import cache_get, cache_put
+from src.concurrency import atomic_path, dataset_lock
+from src.models import load_pipeline, project_batch
+from src.storage import iter_student_data, lookup_student, read_student_row, student_data_path
+
+# Largest number of similar students one search returns
+SIMILAR_STUDENTS_MAX_K = int(os.environ.get('SIMILAR_STUDENTS_MAX_K', 100))
+
+
+def embedding_path(uuid, form_type):
+    return student_data_path(uuid, form_type, 'embedding.npy')
+
+
+def _project(df, pipeline):
+    # float32 PCA coordinates of every row of df, NaN for rows with missing answers
+    valid, components = project_batch(df, pipeline)
+    coordinates = np.full((len(df), pipeline['pca_components'].shape[0]), np.nan, dtype='float32')
+    coordinates[valid] = components
+    return coordinates
+
+
+def _write_embedding(embedding, uuid, form_type):
+    with atomic_path(embedding_path(uuid, form_type)) as tmp_path, open(tmp_path, 'wb') as f:
+        np.save(f, embedding)
+
+
+def save_embedding(uuid, form_type):
+    """Stores the PCA coordinates of every student of a dataset as a float32 array in row order.
+
+    Rows are projected with the stored pipeline, as /api/predict does.
+    Returns False if the dataset has no stored pipeline.
+    """
+    with dataset_lock(uuid, form_type):
+        pipeline = load_pipeline(uuid, form_type)
+        if pipeline is None:
+            return False
+        _write_embedding(np.concatenate([_project(df, pipeline) for df in iter_student_data(uuid, form_type)]), uuid, form_type)
+    return True
+
+
+def extend_embedding(uuid, form_type, df):
+    """Adds the coordinates of rows just appended to a dataset (with upload columns) to its embedding."""
+    with dataset_lock(uuid, form_type):
+        file_path = embedding_path(uuid, form_type)
+        if not os.path.exists(file_path):
+            # Datasets processed before embeddings were stored; the appended rows are already in the data
+            return save_embedding(uuid, form_type)
+        _write_embedding(np.concatenate([np.load(file_path), _project(df, load_pipeline(uuid, form_type))]), uuid, form_type)
+    return True
+
+
+def _load_index(uuid, form_type):
+    # KD-tree over the fully answered rows of a dataset, or None if it has neither an embedding nor a pipeline
+    from sklearn.neighbors import KDTree
+
+    cached = cache_get((form_type, uuid, 'neighbors'))
+    if cached is not None:
+        return cached
+    file_path = embedding_path(uuid, form_type)
+    if not os.path.exists(file_path) and not save_embedding(uuid, form_type):
+        return None
+    with dataset_lock(uuid, form_type, shared=True):
+        embedding = np.load(file_path)
+        rows = np.flatnonzero(~np.isnan(embedding).any(axis=1))
+        tree = KDTree(embedding[rows]) if len(rows) else None
+        index = {'embedding': embedding, 'rows': rows, 'tree': tree,
+                 'tree_data': np.asarray(tree.data) if tree is not None else None}
+        return cache_put((form_type, uuid, 'neighbors'), index)
+
+
+def _nearest(index, point, k):
+    # (distance, row offset) of the k rows of a dataset closest to point
+    if index['tree'] is None or np.isnan(point).any():
+        return []
+    distances, positions = index['tree'].query(point.reshape(1, -1), k=min(k, len(index['rows'])))
+    return [(float(distance), int(index['rows'][position])) for distance, position in zip(distances[0], positions[0])]
+
+
+def _describe(uuid, form_type, row, distance):
+    # Only the hit is read, so a search never loads (or caches) the whole dataset
+    student = read_student_row(uuid, form_type, row).iloc[0]
+    name, gender, grade, cluster = student['Name'], student['Gender'], student['Grade'], student['Cluster']
+    return {
+        'Name': name,
+        # Tells apart students sharing a name, as in /api/student/data
+        'Occurrence': lookup_student(uuid, form_type, name).index(row),
+        'Gender': None if pd.isna(gender) else gender,
+        'Grade': None if pd.isna(grade) else int(grade),
+        'Cluster': None if pd.isna(cluster) else int(cluster),
+        'distance': round(distance, 4),
+    }
+
+
+def similar_students(uuid, form_type, name, k=10, occurrence=0, datasets=None):
+    """Returns the k students closest to a student of dataset uuid in PCA space, per dataset searched.
+
+    datasets maps the uuid of each dataset to search to the record its
+    students are reported under; by default only the student's own dataset
+    is searched. The result is a list of {'record', 'students'} groups, the
+    student's own dataset first, each ranked nearest first. The student is
+    projected into each dataset's own PCA space, whose dimensions differ, so
+    distances are only ranked within a group, never across groups.
+    Returns None if the student or the models of their dataset are not found.
+    """
+    index = _load_index(uuid, form_type)
+    offsets = lookup_student(uuid, form_type, name)
+    if index is None or occurrence >= len(offsets) or offsets[occurrence] >= len(index['embedding']):
+        return None
+    offset = offsets[occurrence]
+    datasets = datasets or {uuid: uuid}
+
+    # The student is their own nearest neighbour
+    nearest = [hit for hit in _nearest(index, index['embedding'][offset], k + 1) if hit[1] != offset][:k]
+    groups = [{'record': datasets.get(uuid, uuid), 'students': [_describe(uuid, form_type, row, distance) for distance, row in nearest]}]
+    for dataset, record in datasets.items():
+        if dataset == uuid:
+            continue
+        other = _load_index(dataset, form_type)
+        if other is None:
+            continue
+        point = _project(read_student_row(uuid, form_type, offset), load_pipeline(dataset, form_type))[0]
+        nearest = _nearest(other, point, k)
+        if nearest:
+            groups.append({'record': record, 'students': [_describe(dataset, form_type, row, distance) for distance, row in nearest]})
+    return groups
@@ -0,0 +1,210 @@
+import logging
+import os
+import pandas as pd
+
+from src.jobs import stage, set_pending_stages
+from src.process import summarize_answers, load_data_and_preprocess, pca, upload_results, kmeans, upload_student_data, get_uploaded_result_by_uuid
+from src.process import iter_upload_chunks, fit_scaler_from_chunks, scale_chunk, pca_from_chunks, OUT_OF_CORE_CHUNK_ROWS
+from src.db import insert_result_record, append_students
+from src.classification import run_model_selection
+from src.models import save_pipeline, write_pipeline, assign_appended_rows
+from src.storage import load_student_data, decode_answers, save_student_data_from_chunks
+from src.answer_cube import refresh_answer_cube
+from src.metrics import inc
+from src.concurrency import dataset_lock, scratch_dir
+from src.neighbors import save_embedding, extend_embedding
+
+# Wall-clock budget (seconds) for fitting the classifiers; slower models are dropped and their processes killed (0 waits for all)
+CLASSIFICATION_TIME_BUDGET = float(os.environ.get('CLASSIFICATION_TIME_BUDGET', 300)) or None
+# Classifiers are trained on a random sample of at most this many rows
+CLASSIFICATION_MAX_ROWS = int(os.environ.get('CLASSIFICATION_MAX_ROWS', 20000))
+# Appended rows re-fit the whole dataset once they sit this much farther from their centroids than the fitted rows
+APPEND_DRIFT_THRESHOLD = float(os.environ.get('APPEND_DRIFT_THRESHOLD', 0.25))
+
+FIT_STAGES = ['preprocess', 'pca', 'kmeans', 'student_data', 'answers_summary', 'classification', 'save_models']
+UPLOAD_PIPELINE_STAGES = FIT_STAGES + ['save_results']
+APPEND_PIPELINE_STAGES = ['assign', 'student_data', 'answers_summary', 'save_results']
+
+logger = logging.getLogger(__name__)
+
+
+def _finish_fit(job_id, df_pca, fitted, uuid, form_type, user, optimal_pc, optimal_k, cluster_count):
+    # Stages shared by the in-memory and out-of-core fits once the student data is stored
+    with stage(job_id, 'answers_summary'):
+        summary = summarize_answers(uuid, form_type, 'all', 'all', 'all')
+
+    # Classifiers are saved in the job's own folder and only published with the pipeline
+    classifier_dir = os.path.join(scratch_dir(job_id), 'models')
+    with stage(job_id, 'classification'):
+        best_model = run_model_selection(df_pca, 'Cluster', time_budget=CLASSIFICATION_TIME_BUDGET,
+                                         model_dir=classifier_dir, max_rows=CLASSIFICATION_MAX_ROWS)
+
+    with stage(job_id, 'save_models'):
+        save_pipeline(fitted, uuid, form_type, classifier=best_model, classifier_dir=classifier_dir)
+        # PCA coordinates of every student, for the similar students search
+        save_embedding(uuid, form_type)
+
+    return {
+        'id': uuid,
+        'user': user,
+        'type': form_type,
+        'data_summary': {
+            'answers_summary': summary,
+            'pca_summary': {
+                'optimal_pc': optimal_pc
+            },
+            'cluster_summary': {
+                'optimal_k': optimal_k,
+                'cluster_count': cluster_count
+            },
+            'classification_summary': best_model
+        }
+    }
+
+
+def fit_dataset(job_id, df, uuid, form_type, user, refit=False):
+    """Fits scaler, PCA, KMeans and the classifiers on a dataset, stores everything and returns the results payload.
+
+    With refit the dataset already exists, and its pending cluster overrides
+    are dropped together with the old student data.
+    """
+    # Fitted scaler, PCA projection and KMeans model, kept for /api/predict
+    fitted = {}
+
+    with stage(job_id, 'preprocess'):
+        df, df_questions_only, df_scaled = load_data_and_preprocess(df, form_type, fitted=fitted)
+
+    with stage(job_id, 'pca'):
+        df_pca, optimal_pc = pca(df_scaled, fitted=fitted)
+
+    with stage(job_id, 'kmeans'):
+        df_pca, optimal_k, cluster_count, df_original_questions_only = kmeans(df_pca, df_questions_only, fitted=fitted)
+
+    with stage(job_id, 'student_data'):
+        upload_student_data(df_pca, df, uuid, form_type, clear_overrides=refit)
+    inc('rows_processed_total', len(df_pca), step='fit')
+
+    return _finish_fit(job_id, df_pca, fitted, uuid, form_type, user, optimal_pc, optimal_k, cluster_count)
+
+
+def fit_dataset_out_of_core(job_id, file_path, uuid, form_type, user):
+    """Variant of fit_dataset for uploads too large for memory, read from the saved upload in chunks.
+
+    The scaler is fitted with partial_fit and the PCA with IncrementalPCA,
+    each in a pass over the file; only the PCA projection is held in memory.
+    KMeans sweeps a sample and the student data is written batch by batch.
+    """
+    fitted = {}
+
+    def upload_chunks():
+        return iter_upload_chunks(file_path, form_type, OUT_OF_CORE_CHUNK_ROWS)
+
+    with stage(job_id, 'preprocess'):
+        scaler, feature_columns = fit_scaler_from_chunks(upload_chunks, form_type, fitted=fitted)
+
+    with stage(job_id, 'pca'):
+        df_pca, optimal_pc = pca_from_chunks(
+            lambda: (scale_chunk(chunk, scaler, feature_columns, form_type) for chunk in upload_chunks()), fitted=fitted)
+
+    with stage(job_id, 'kmeans'):
+        df_pca, optimal_k, cluster_count, _ = kmeans(df_pca, None, fitted=fitted)
+
+    with stage(job_id, 'student_data'), dataset_lock(uuid, form_type):
+        clusters = df_pca['Cluster']
+        save_student_data_from_chunks(
+            (chunk.assign(Cluster=clusters.reindex(chunk.index).astype('Int8')) for chunk in upload_chunks()), uuid, form_type)
+        refresh_answer_cube(uuid, form_type)
+    inc('rows_processed_total', len(df_pca), step='fit_out_of_core')
+
+    return _finish_fit(job_id, df_pca, fitted, uuid, form_type, user, optimal_pc, optimal_k, cluster_count)
+
+
+def run_upload_pipeline(job_id, df, uuid, record_name, form_type, user, upload_path=None, content_hash=None):
+    """Runs the full processing pipeline for an ingested upload and returns the results payload.
+
+    Pass df=None and the path from store_upload to process a large upload out
+    of core. content_hash registers the dataset for reuse by identical uploads.
+    """
+    if df is None:
+        results = fit_dataset_out_of_core(job_id, upload_path, uuid, form_type, user)
+    else:
+        results = fit_dataset(job_id, df, uuid, form_type, user)
+
+    with stage(job_id, 'save_results'):
+        results_path = upload_results(results)
+        if not insert_result_record(uuid, record_name, user, form_type, content_hash=content_hash) or not results_path:
+            logger.error("Failed to insert result record or save results for %s", uuid)
+            raise RuntimeError('Failed to insert result record')
+
+    return results
+
+
+def _refit_with_appended_rows(job_id, df, uuid, form_type, owner):
+    # Everything stored so far plus the new rows, with text answers as in an upload
+    stored = decode_answers(load_student_data(uuid, form_type), form_type).drop(columns=['Cluster'])
+    combined = pd.concat([stored, df], ignore_index=True)
+
+    set_pending_stages(job_id, UPLOAD_PIPELINE_STAGES)
+    return fit_dataset(job_id, combined, uuid, form_type, owner, refit=True)
+
+
+def run_append_pipeline(job_id, df, uuid, form_type, user, drift_threshold=APPEND_DRIFT_THRESHOLD):
+    """Adds a new wave of responses to an existing dataset and returns the updated results payload.
+
+    New rows are projected and clustered with the stored models and the
+    student data and answer cube are extended in place. The whole dataset is
+    re-fitted instead when the drift of the appended rows exceeds
+    drift_threshold, or when the dataset has no stored models.
+    """
+    # One append at a time per dataset (in any worker process), since each one updates the stored centroids
+    with dataset_lock(uuid, form_type, name='append'):
+        return _append(job_id, df, uuid, form_type, user, drift_threshold)
+
+
+def _append(job_id, df, uuid, form_type, user, drift_threshold):
+    results = get_uploaded_result_by_uuid(uuid, form_type)
+    if results is None:
+        raise RuntimeError('Dataset not found')
+
+    with stage(job_id, 'assign'):
+        assignment = assign_appended_rows(uuid, form_type, df)
+
+    drift = None if assignment is None else assignment[1]
+    refit = drift is None or drift > drift_threshold
+    if refit:
+        # The record keeps its owner; user only appended the rows
+        results = _refit_with_appended_rows(job_id, df, uuid, form_type, results.get('user', user))
+    else:
+        clusters, drift, pipeline = assignment
+        with stage(job_id, 'student_data'):
+            rows = df.copy()
+            rows['Cluster'] = pd.array(clusters, dtype='Int8')
+            # The embedding grows with the rows, so searches never see one without the other
+            with dataset_lock(uuid, form_type):
+                if not append_students(uuid, form_type, rows):
+                    raise RuntimeError('Failed to append student data')
+                extend_embedding(uuid, form_type, df)
+            write_pipeline(pipeline, uuid, form_type)
+        inc('rows_processed_total', len(df), step='append')
+
+        with stage(job_id, 'answers_summary'):
+            cluster_sizes = load_student_data(uuid, form_type, columns=['Cluster'])['Cluster'].value_counts()
+            data_summary = results['data_summary']
+            data_summary['answers_summary'] = summarize_answers(uuid, form_type, 'all', 'all', 'all')
+            data_summary['cluster_summary']['cluster_count'] = {
+                "Cluster " + str(cluster + 1): int(cluster_sizes.get(cluster, 0))
+                for cluster in range(data_summary['cluster_summary']['optimal_k'])
+            }
+
+    results['data_summary']['append_summary'] = {
+        'appended_rows': len(df),
+        'drift': None if drift is None else round(drift, 4),
+        'drift_threshold': drift_threshold,
+        'refit': refit
+    }
+
+    with stage(job_id, 'save_results'):
+        if not upload_results(results):
+            raise RuntimeError('Failed to save results')
+
+    return results
@@ -1,214 +1,426 @@
 import pandas as pd
 import numpy as np
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
-from sklearn.cluster import KMeans
+import csv
+import gzip
+import hashlib
 import io
 import json
+import logging
 import os
+import time
+
+from src.schemas import DatasetSchemaError, GENDER_CODES, answer_codes, check_header, upload_dtypes
+from src.storage import save_student_data, encode_features
+from src.answer_cube import load_answer_cube, refresh_answer_cube, summarize_answer_cube
+from src.metrics import inc
+from src.concurrency import atomic_path, dataset_lock
+from src.cache import cache_get, cache_put
+
+try:
+    import brotli
+except ImportError:
+    # Brotli is optional; without it results are served gzip-compressed only
+    brotli = None
 
 def validate_dataset(columns, type):
-    expected_columns = []
-    if type == 'ASSI-A':
-        expected_columns = ['Name', 'Gender', 'Grade', 'Because I need at least a high-school degree in order to find a high-paying job later on.', 'Because I experience pleasure and satisfaction while learning new things.', 'Because I think that a high-school education will help me better prepare for the career I have chosen.', 'Because I really like going to school.', "Honestly, I don't know; I really feel that I am wasting my time in school.", 'For the pleasure I experience while surpassing myself in my studies.', 'To prove to myself that I am capable of completing my high-school degree.', 'In order to obtain a more prestigious job later on.', 'For the pleasure I experience when I discover new things never seen before.', 'Because eventually it will enable me to enter the job market in a field that I like.', 'Because for me, school is fun.', 'I once had good reasons for going to school; however, now I wonder whether I should continue.', 'For the pleasure that I experience while I am surpassing myself in one of my personal accomplishments.', 'Because of the fact that when I succeed in school I feel\r\nimportant.', 'Because I want to have "the good life" later on.', 'For the pleasure that I experience in broadening my\r\nknowledge about subjects which appeal to me.', 'Because this will help me make a better choice regarding my career orientation.', 'For the pleasure that I experience when I am taken by\r\ndiscussions with interesting teachers.', "I can't see why I go to school and frankly, I couldn't care\r\nless.", 'For the satisfaction I feel when I am in the process of\r\naccomplishing difficult academic activities.', 'To show myself that I am an intelligent person.', 'In order to have a better salary later on.', 'Because my studies allow me to continue to learn about\r\nmany things that interest me.', 'Because I believe that my high school education will\r\nimprove my competence as a worker.', 'For the "high" feeling that I experience while reading about various interesting subjects.', "I don't know; I can't understand what I am doing in school.", 'Because high school allows me to experience a personal satisfaction in my quest for excellence in my studies.', 'Because I want to show myself that I can succeed in my\r\nstudies.']
-    elif type == 'ASSI-C':
-        expected_columns = ['Name', 'Gender', 'Grade', 'Complain of aches or pains', 'Spend more time alone', 'Tire easily, little energy', 'Fidgety, unable to sit still', 'Have trouble with teacher', 'Less interested in school', 'Act as if driven by motor', 'Daydream too much', 'Distract easily', 'Are afraid of new situations', 'Feel sad, unhappy', 'Are irritable, angry', 'Feel hopeless', 'Have trouble concentrating', 'Less interested in friends', 'Fight with other children', 'Absent from school', 'School grades dropping', 'Down on yourself', 'Visit doctor with doctor finding nothing\r\nwrong', 'Have trouble sleeping', 'Worry a lot', 'Want to be with parent more than before', 'Feel that you are bad', 'Take unnecessary risks', 'Get hurt frequently', 'Seem to be having less fun', 'Act younger than children your age', 'Do not listen to rules', 'Do not show feelings', "Do not understand other people's feelings", 'Tease others', 'Blame others for your troubles', 'Take things that do not belong to you', 'Refuse to share']
-    
-    missing_columns = [col for col in expected_columns if col not in columns]
-    return False if missing_columns else True
-
-def upload_file(file, id, form_type):
-    stream = io.StringIO(file.stream.read().decode("UTF8"), newline=None)
-    root_save_folder = 'uploads'
-    if not os.path.exists(root_save_folder):
-        os.makedirs(root_save_folder)
-
-    type_save_folder = os.path.join(root_save_folder, form_type)
-    if not os.path.exists(type_save_folder):
-        os.makedirs(type_save_folder)
-    
-    csv_content = stream.getvalue()
-    
-    file_path =  os.path.join(type_save_folder, f'{id}.csv')
-    with open(file_path, 'w', encoding='utf-8') as f:
-        f.write(csv_content)
-    df = pd.read_csv(file_path)
-    df['Name'] = df['Name'].astype(str)
-    df.to_csv(file_path, index=False)
-    return file_path
+    try:
+        check_header(columns, type)
+        return True
+    except DatasetSchemaError:
+        return False
+
+UPLOADS_FOLDER = 'uploads'
+# Rows parsed per chunk while ingesting an upload
+INGEST_CHUNK_ROWS = int(os.environ.get('INGEST_CHUNK_ROWS', 5000))
+# Compression level of the gzip copy stored next to each results file (1-9)
+RESULTS_GZIP_LEVEL = int(os.environ.get('RESULTS_GZIP_LEVEL', 9))
+# Bytes copied from the request stream per read
+INGEST_READ_BYTES = 1024 * 1024
+# Uploads larger than this (megabytes) are processed out of core, from disk in chunks of OUT_OF_CORE_CHUNK_ROWS rows
+OUT_OF_CORE_MB = float(os.environ.get('OUT_OF_CORE_MB', 64))
+OUT_OF_CORE_CHUNK_ROWS = int(os.environ.get('OUT_OF_CORE_CHUNK_ROWS', 50000))
+
+logger = logging.getLogger(__name__)
+
+class UploadDigest:
+    """SHA-256 of an upload's content and form type, fed while the upload streams to disk.
+
+    A UTF-8 BOM, the line ending style and trailing line breaks are ignored,
+    so the same export saved on different systems hashes the same.
+    """
+
+    def __init__(self, form_type):
+        self._hash = hashlib.sha256(form_type.encode('utf-8') + b'\0')
+        self._head = b''
+        self._pending = b''
+
+    def update(self, data):
+        if self._head is not None:
+            # Hold the first bytes back until a BOM can be recognized
+            self._head += data
+            if len(self._head) < 3:
+                return
+            data = self._head[3:] if self._head.startswith(b'\xef\xbb\xbf') else self._head
+            self._head = None
+        data = self._pending + data
+        # Trailing line breaks wait for the next read: a \r may be the first half of \r\n
+        body = data.rstrip(b'\r\n')
+        self._pending = data[len(body):]
+        self._hash.update(body.replace(b'\r\n', b'\n').replace(b'\r', b'\n'))
+
+    def hexdigest(self):
+        if self._head:
+            self._head, head = None, self._head
+            self.update(head)
+        return self._hash.hexdigest()
+
+
+class _TeeReader(io.RawIOBase):
+    """Readable byte stream that copies everything read from source into sink (and digest)."""
+
+    def __init__(self, source, sink, digest=None):
+        self._source = source
+        self._sink = sink
+        self._digest = digest
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._source.read(min(len(buffer), INGEST_READ_BYTES))
+        self._sink.write(data)
+        if self._digest is not None:
+            self._digest.update(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+def upload_path(id, form_type):
+    return os.path.join(UPLOADS_FOLDER, form_type, f'{id}.csv')
+
+def _read_upload_chunks(text, form_type, chunksize):
+    # Headers can span several lines (quoted line breaks), so read exactly one CSV record
+    header = next(csv.reader(text), [])
+    columns = check_header(header, form_type)
+    for chunk in pd.read_csv(text, header=None, names=columns, chunksize=chunksize, dtype=upload_dtypes(form_type)):
+        chunk['Name'] = chunk['Name'].astype(str)
+        yield chunk
+
+def _receive_upload(file, id, form_type, parse, digest):
+    file_path = upload_path(id, form_type)
 
-def upload_student_data(df, id, form_type):
-    root_save_folder = 'student_data'
-    df_original = pd.read_csv(f'uploads/{form_type}/{id}.csv')
-    df_original['Cluster'] = df['Cluster']
-        
-    if not os.path.exists(root_save_folder):
-        os.makedirs(root_save_folder)
+    try:
+        # The upload only appears under its name once it was received completely
+        with atomic_path(file_path) as tmp_path, open(tmp_path, 'wb') as sink:
+            buffered = io.BufferedReader(_TeeReader(file.stream, sink, digest))
+            text = io.TextIOWrapper(buffered, encoding='utf-8-sig', newline='')
+            if not parse:
+                # Only the header is checked; the rest is copied to disk unparsed
+                check_header(next(csv.reader(text), []), form_type)
+                while buffered.read(INGEST_READ_BYTES):
+                    pass
+                return file_path
+            chunks = list(_read_upload_chunks(text, form_type, INGEST_CHUNK_ROWS))
+        # Chunks can disagree on inferred categories (e.g. Gender), which concat would widen to object
+        df = pd.concat(chunks, ignore_index=True)
+        if df['Gender'].dtype == object:
+            df['Gender'] = df['Gender'].astype('category')
+        inc('rows_processed_total', len(df), step='ingest')
+        return df
+    except DatasetSchemaError as e:
+        logger.warning("Rejected upload %s: %s. Missing: %s. Unexpected: %s", id, e, e.missing, e.extra)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+    except Exception as e:
+        logger.exception("Error ingesting upload %s", id)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        return None
 
-    type_save_folder = os.path.join(root_save_folder, form_type)
-    if not os.path.exists(type_save_folder):
-        os.makedirs(type_save_folder)
+def ingest_upload(file, id, form_type, digest=None):
+    """Parses an uploaded CSV once, in chunks, while persisting the raw bytes to uploads/.
+
+    The header record is checked against the form schema before any data row
+    is parsed; a mismatch removes the partial file and raises
+    DatasetSchemaError with the missing and unexpected columns. Returns the
+    parsed DataFrame, or None if the file cannot be read (in which case
+    nothing is left on disk either). Pass an UploadDigest to hash the content
+    in the same pass.
+    """
+    return _receive_upload(file, id, form_type, parse=True, digest=digest)
+
+def store_upload(file, id, form_type, digest=None):
+    """Checks the header of an upload and streams it to uploads/ without parsing it.
+
+    Used for uploads too large to hold in memory, which are then processed
+    from disk with iter_upload_chunks. Returns the saved path, or None on
+    failure; header mismatches raise DatasetSchemaError as in ingest_upload.
+    """
+    return _receive_upload(file, id, form_type, parse=False, digest=digest)
+
+def iter_upload_chunks(file_path, form_type, chunksize=INGEST_CHUNK_ROWS):
+    """Yields a saved upload as typed DataFrame chunks whose index continues across chunks."""
+    with open(file_path, 'r', encoding='utf-8-sig', newline='') as text:
+        yield from _read_upload_chunks(text, form_type, chunksize)
+
+def upload_student_data(df, df_original, id, form_type, clear_overrides=False):
+    df_original = df_original.copy()
+    df_original['Cluster'] = df['Cluster']
 
-    file_path = os.path.join(type_save_folder, f'{id}.csv')
-    df_original.to_csv(file_path, index=False)
+    with dataset_lock(id, form_type):
+        file_path = save_student_data(df_original, id, form_type)
+        if clear_overrides:
+            # A re-fit renumbers the clusters; pending counselor overrides go with the data they refer to
+            from src.db import clear_cluster_overrides
 
+            if not clear_cluster_overrides(id, form_type):
+                raise RuntimeError('Failed to clear the cluster overrides of the re-fitted dataset')
+        refresh_answer_cube(id, form_type)
     return file_path
 
-def upload_results(results):
-    id = results['id']
-    form_type = results['type']
-    root_save_folder = 'results'
+def results_path(id, form_type):
+    return os.path.join('results', form_type, f'{id}.json')
 
-    # Create root directory if it doesn't exist
-    if not os.path.exists(root_save_folder):
-        os.makedirs(root_save_folder, exist_ok=True)
+def _result_encodings():
+    # Content encodings stored next to each results file, by file suffix
+    return {'gzip': '.gz', 'br': '.br'} if brotli is not None else {'gzip': '.gz'}
 
-    # Create type-specific directory if it doesn't exist
-    type_save_folder = os.path.join(root_save_folder, form_type)
-    if not os.path.exists(type_save_folder):
-        os.makedirs(type_save_folder, exist_ok=True)
+def _compress(raw, encoding):
+    if encoding == 'br':
+        return brotli.compress(raw)
+    # mtime=0 keeps the bytes identical for identical results
+    return gzip.compress(raw, compresslevel=RESULTS_GZIP_LEVEL, mtime=0)
+
+def _results_payload(results):
+    # Compact JSON, its compressed copies and its ETag, as served by the API
+    raw = json.dumps(results, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    payload = {'etag': hashlib.sha256(raw).hexdigest()[:32], 'identity': raw}
+    for encoding in _result_encodings():
+        payload[encoding] = _compress(raw, encoding)
+    return payload
+
+def upload_results(results):
+    """Stores results as compact JSON, together with its compressed copies and ETag (<id>.json.etag)."""
+    file_path = results_path(results['id'], results['type'])
+    payload = _results_payload(results)
+
+    files = {'': payload['identity'], '.etag': payload['etag'].encode('ascii')}
+    files.update({suffix: payload[encoding] for encoding, suffix in _result_encodings().items()})
 
-    file_path = os.path.join(type_save_folder, f'{id}.json')
-    
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(results, f, ensure_ascii=False, indent=4)
+        with dataset_lock(results['id'], results['type']):
+            for suffix, content in files.items():
+                with atomic_path(file_path + suffix) as tmp_path:
+                    with open(tmp_path, 'wb') as f:
+                        f.write(content)
+            cache_put((results['type'], results['id'], 'results'), payload)
         return file_path
     except Exception as e:
-        print(f"Error saving results: {e}")
+        logger.exception("Error saving results")
         return None
 
+def _read_results_payload(file_path):
+    # None for results stored before ETags and compressed copies were kept
+    try:
+        with open(file_path + '.etag', 'r', encoding='ascii') as f:
+            payload = {'etag': f.read().strip()}
+        with open(file_path, 'rb') as f:
+            payload['identity'] = f.read()
+    except FileNotFoundError:
+        return None
+    for encoding, suffix in _result_encodings().items():
+        if os.path.exists(file_path + suffix):
+            with open(file_path + suffix, 'rb') as f:
+                payload[encoding] = f.read()
+    return payload
+
+def load_results_payload(id, type, record_id=None):
+    """Returns the stored results of dataset id ready to serve, or None if there are none.
+
+    The payload maps 'etag' to the ETag of the results and each available
+    content encoding ('identity', 'gzip' and, with brotli installed, 'br') to
+    the response body. record_id is a record sharing the dataset; its
+    payload carries its own id, and so its own ETag.
+    """
+    record_id = record_id or id
+    cached = cache_get((type, record_id, 'results'))
+    if cached is not None:
+        return cached
+    file_path = results_path(id, type)
+    with dataset_lock(id, type, shared=True):
+        if not os.path.exists(file_path):
+            logger.debug("Results not found: %s", file_path)
+            return None
+        payload = _read_results_payload(file_path) if record_id == id else None
+        if payload is None:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                results = json.load(f)
+            results['id'] = record_id
+            payload = _results_payload(results)
+        return cache_put((type, record_id, 'results'), payload)
+
 def summarize_answers(uuid, form_type, gender, grade, cluster):
-    file_path = os.path.join('student_data', form_type, f'{uuid}.csv')
-    df = pd.read_csv(file_path)
-    df = df.dropna(axis=0)
-
-    if form_type == 'ASSI-C':
-        # Convert 'Never', 'Sometimes', 'Often' to numerical values
-        answer_map = {'Never': 0, 'Sometimes': 1, 'Often': 2}
-        for col in df.columns:
-            if col not in ['Gender', 'Grade', 'Name']:
-                df[col] = df[col].map(answer_map)
-
-    summary = {}
-    # Filter the dataframe by gender and grade if they're not set to 'all'
-    if gender != 'all':
-        df = df[df['Gender'] == gender]
-    if grade != 'all':
-        df = df[df['Grade'] == int(grade)]
-    if cluster != 'all':
-        df = df[df['Cluster'] == int(cluster)]
-    print(df.head(1))
-        
-    for column in df.columns:
-        if column not in ['Name', 'Grade', 'Gender']:
-            summary[column] = df[column].value_counts().to_dict()
-    
-    return summary
+    # Answers are counted from the precomputed cube as integer codes ('Never', 'Sometimes', 'Often' -> 0, 1, 2 for ASSI-C)
+    cube = load_answer_cube(uuid, form_type)
+    return summarize_answer_cube(cube, gender, grade, cluster)
 
 def summarize_answer_per_cluster(df_clustered, form_type):
+    # Codes are turned back into text answers once per distinct value, not per cell
+    codes = answer_codes(form_type) or {}
+    answer_labels = {code: label for label, code in codes.items()}
+    gender_labels = {code: label for label, code in GENDER_CODES.items()}
+
     summary = []
-    for cluster in df_clustered['Cluster'].unique():
-        summary_cluster = {}
-        df_cluster = df_clustered[df_clustered['Cluster'] == cluster]
-        summary_cluster['cluster'] = cluster
-        for column in df_cluster.columns:
-            if column != 'Cluster':
-                summary_cluster[column] = df_cluster[column].value_counts().to_dict()
+    for cluster, df_cluster in df_clustered.groupby('Cluster', sort=False):
+        summary_cluster = {'cluster': cluster}
+        for column in df_cluster.columns.drop('Cluster'):
+            labels = gender_labels if column == 'Gender' else answer_labels
+            counts = df_cluster[column].value_counts()
+            summary_cluster[column] = {labels.get(value, value): count for value, count in counts.items()}
         summary.append(summary_cluster)
-
-    # For ASSI-C form type, revert numerical values back to text answers
-    if form_type == 'ASSI-C':
-        # Define the reverse mapping from numerical values to text answers
-        reverse_answer_map = {0: 'Never', 1: 'Sometimes', 2: 'Often'}
-        
-        # For each cluster in the summary
-        for cluster_summary in summary:
-            # For each question in the cluster
-            for question, answers in cluster_summary.items():
-                # Skip the cluster identifier
-                if question != 'cluster':
-                    # Create a new dictionary with text answers
-                    text_answers = {}
-                    for num_value, count in answers.items():
-                        # Handle gender column specifically
-                        if question == 'Gender':
-                            if num_value == 0:
-                                text_answers['Female'] = count
-                            elif num_value == 1:
-                                text_answers['Male'] = count
-                            else:
-                                text_answers[num_value] = count
-                        # Convert the numerical key to text if it's in our mapping
-                        elif isinstance(num_value, (int, float)) and num_value in reverse_answer_map:
-                            text_answers[reverse_answer_map[num_value]] = count
-                        else:
-                            # Keep as is if not a numerical value we're mapping
-                            text_answers[num_value] = count
-                    
-                    # Replace the numerical answers with text answers
-                    cluster_summary[question] = text_answers
     return summary
 
 
-def load_data_and_preprocess(file_path, form_type):
-    # Full DataFrame
-    df = pd.read_csv(file_path)
+def load_data_and_preprocess(df, form_type, fitted=None):
+    """Encodes and scales the answers; the fitted scaler and its feature columns go into fitted if given."""
+    # scikit-learn is imported lazily so workers that only serve reads never load it
+    from sklearn.preprocessing import StandardScaler
+
+    # Only questions, with Gender and the answers as float32 codes ('Never', 'Sometimes', 'Often' -> 0, 1, 2 for ASSI-C)
+    df_questions_only = encode_features(df.drop(columns=['Name', 'Grade']), form_type)
 
-    
-    # Only questions
-    df_questions_only = df.drop(columns=['Name', 'Grade'])
-
-    if form_type == 'ASSI-C':
-        # Convert 'Never', 'Sometimes', 'Often' to numerical values
-        answer_map = {'Never': 0, 'Sometimes': 1, 'Often': 2}
-        for col in df_questions_only.columns:
-            if col not in ['Gender', 'Grade', 'Name']:
-                df_questions_only[col] = df_questions_only[col].map(answer_map)
-
-    # Transform Gender to Numeric
-    df_questions_only['Gender'] = df_questions_only['Gender'].map({'Female': 0, 'Male': 1})
-    
     # Remove Na
     df_questions_only = df_questions_only.dropna(axis=0)
 
+    # StandardScaler keeps float32, so PCA, KMeans and the classifiers all run in float32
     scaler = StandardScaler()
     # Scaled Only Questions
     df_scaled = scaler.fit_transform(df_questions_only)
+    if fitted is not None:
+        fitted['scaler'] = scaler
+        fitted['feature_columns'] = df_questions_only.columns.to_list()
     
     # Scaled Full Dataframe, including Name and grade
     df_scaled = pd.DataFrame(df_scaled, columns=df_questions_only.columns)
     df_scaled['Name'] = df['Name']
     df_scaled['Grade'] = df['Grade']
-    
-    root_save_folder = 'uploads'
-    if not os.path.exists(root_save_folder):
-        os.makedirs(root_save_folder)
-    filename = os.path.join(root_save_folder, 'full_df.csv')
-    df.to_csv(filename, index=False)
 
+    return df, df_questions_only, df_scaled
+
+def fit_scaler_from_chunks(make_chunks, form_type, fitted=None):
+    """Out-of-core variant of load_data_and_preprocess: fits the scaler one chunk at a time.
 
-    return df, df_questions_only, df_scaled, 
+    make_chunks() must return a fresh iterator of upload chunks. Returns
+    (scaler, feature_columns) for scale_chunk.
+    """
+    from sklearn.preprocessing import StandardScaler
+
+    scaler = StandardScaler()
+    feature_columns = None
+    for chunk in make_chunks():
+        features = encode_features(chunk.drop(columns=['Name', 'Grade']), form_type).dropna(axis=0)
+        feature_columns = features.columns.to_list()
+        if len(features):
+            scaler.partial_fit(features)
+    if fitted is not None:
+        fitted['scaler'] = scaler
+        fitted['feature_columns'] = feature_columns
+    return scaler, feature_columns
+
+def scale_chunk(chunk, scaler, feature_columns, form_type):
+    """Encodes and scales one upload chunk like load_data_and_preprocess, keeping its row index."""
+    features = encode_features(chunk[feature_columns], form_type).dropna(axis=0)
+    df_scaled = pd.DataFrame(scaler.transform(features), columns=feature_columns, index=features.index)
+    df_scaled['Name'] = chunk['Name']
+    df_scaled['Grade'] = chunk['Grade']
+    return df_scaled
 
 def count_items_in_cluster(df_pca, cluster):
     return df_pca[df_pca['Cluster'] == cluster].shape[0]
 
-def kmeans(df_pca, df_original_questions_only):
+# Above this many rows the elbow sweep runs on a random sample with MiniBatchKMeans
+KMEANS_SWEEP_MAX_ROWS = int(os.environ.get('KMEANS_SWEEP_MAX_ROWS', 20000))
+# Stop sweeping larger k once adding a cluster removes less than this share of the k=1 inertia
+KMEANS_MIN_IMPROVEMENT = float(os.environ.get('KMEANS_MIN_IMPROVEMENT', 0.01))
+# From this many rows the final fit on the full data is also a MiniBatchKMeans
+KMEANS_MINIBATCH_MIN_ROWS = int(os.environ.get('KMEANS_MINIBATCH_MIN_ROWS', 200000))
+
+def _fit_kmeans_for_k(k, X, use_minibatch):
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    if use_minibatch:
+        model = MiniBatchKMeans(n_clusters=k, random_state=42, n_init=3, batch_size=4096)
+    else:
+        model = KMeans(n_clusters=k, random_state=42, n_init=10)
+    model.fit(X)
+    return model
+
+def select_k(X, k_range=range(1, 11), max_rows=KMEANS_SWEEP_MAX_ROWS, min_improvement=KMEANS_MIN_IMPROVEMENT, n_jobs=-1):
+    """Runs the elbow sweep over k_range in parallel and returns (optimal_k, distortions, fitted models by k).
+
+    Candidate k values are fitted concurrently in waves of n_jobs. Larger
+    datasets are swept on a sample of max_rows rows with MiniBatchKMeans, in
+    which case the returned models were fitted on the sample only.
+    """
+    from joblib import Parallel, delayed, effective_n_jobs
+
+    use_minibatch = max_rows is not None and X.shape[0] > max_rows
+    if use_minibatch:
+        rng = np.random.default_rng(42)
+        X_sweep = X[rng.choice(X.shape[0], size=max_rows, replace=False)]
+    else:
+        X_sweep = X
+
+    k_values = list(k_range)
+    wave_size = max(3, min(len(k_values), effective_n_jobs(n_jobs)))
+    models = {}
+    distortions = []
+    with Parallel(n_jobs=min(wave_size, effective_n_jobs(n_jobs))) as parallel:
+        for i in range(0, len(k_values), wave_size):
+            wave = k_values[i:i + wave_size]
+            fitted = parallel(delayed(_fit_kmeans_for_k)(k, X_sweep, use_minibatch) for k in wave)
+            for k, model in zip(wave, fitted):
+                models[k] = model
+                distortions.append(model.inertia_)  # Inertia is the sum of squared distances to the closest centroid
+
+            # Early termination once the curve has flattened out
+            if min_improvement and len(distortions) >= 3 and distortions[0] > 0:
+                if (distortions[-2] - distortions[-1]) / distortions[0] < min_improvement:
+                    break
+
+    # Find the optimal number of clusters (elbow point)
+    optimal_k = k_values[int(np.argmax(np.diff(distortions, 2))) + 1]  # Second derivative to find the elbow
+    return optimal_k, distortions, models, use_minibatch
+
+def kmeans(df_pca, df_original_questions_only, fitted=None):
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
     try:
+        X = df_pca.drop(columns=['Name', 'Grade']).to_numpy()
+
         # Use the Elbow Method to find the optimal number of clusters
-        distortions = []
-        K = range(1, 11)
-        for k in K:
-            kmeans = KMeans(n_clusters=k, random_state=42, n_init=10)
-            kmeans.fit(df_pca.drop(columns=['Name', 'Grade']))
-            distortions.append(kmeans.inertia_)  # Inertia is the sum of squared distances to the closest centroid
-
-        # Find the optimal number of clusters (elbow point)
-        optimal_k = np.argmax(np.diff(distortions, 2)) + 2  # Second derivative to find the elbow
-        
-        # Fit KMeans with optimal number of clusters
-        kmeans = KMeans(n_clusters=optimal_k, random_state=42, n_init=10)
-        df_pca['Cluster'] = kmeans.fit_predict(df_pca.drop(columns=['Name', 'Grade']))
+        start = time.perf_counter()
+        optimal_k, distortions, models, sampled = select_k(X)
+        sweep_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if sampled:
+            # Refine the sample centroids on the full data with a single warm-started run
+            centers = models[optimal_k].cluster_centers_
+            if X.shape[0] >= KMEANS_MINIBATCH_MIN_ROWS:
+                kmeans = MiniBatchKMeans(n_clusters=optimal_k, init=centers, n_init=1, random_state=42, batch_size=4096)
+            else:
+                kmeans = KMeans(n_clusters=optimal_k, init=centers, n_init=1, random_state=42)
+            labels = kmeans.fit_predict(X)
+        else:
+            # The sweep already fitted the winning k on the full data
+            kmeans = models[optimal_k]
+            labels = kmeans.labels_
+        df_pca['Cluster'] = labels
+        if fitted is not None:
+            fitted['kmeans'] = kmeans
+        final_time = time.perf_counter() - start
+        logger.info("KMeans timings: sweep over k=1..%d %.3fs%s, final fit %.3fs", len(distortions), sweep_time, ' (sampled)' if sampled else '', final_time)
 
         cluster_count = {}
 
@@ -216,46 +428,116 @@ def kmeans(df_pca, df_original_questions_only):
         for cluster in range(optimal_k):
             cluster_count["Cluster " + str(cluster + 1)] = count_items_in_cluster(df_pca, cluster)
         
-        df_original_questions_only['Cluster'] = df_pca['Cluster'].apply(lambda x: f'cluster_{x+1}')
+        if df_original_questions_only is not None:
+            df_original_questions_only['Cluster'] = df_pca['Cluster'].apply(lambda x: f'cluster_{x+1}')
         optimal_k = int(optimal_k)
         return df_pca, optimal_k, cluster_count, df_original_questions_only
 
     except Exception as e:
-        print(f"Error in kmeans: {e}")
+        logger.exception("Error in kmeans")
         return None, None
 
 
-def pca(df_scaled):
-        pca = PCA()
-        optimal_pc = None
-        df_name_grade = df_scaled[['Name', 'Grade']]
-        df_scaled_questions_only = df_scaled.drop(columns=['Name', 'Grade'])
+# Components the randomized SVD solver computes first in pca(), doubled while all of them pass the Kaiser criterion
+PCA_RANDOMIZED_COMPONENTS = int(os.environ.get('PCA_RANDOMIZED_COMPONENTS', 16))
+# Rows per batch when fitting IncrementalPCA
+PCA_BATCH_SIZE = int(os.environ.get('PCA_BATCH_SIZE', 10000))
+
+def _project(X, mean, components):
+    # Equivalent to PCA.transform restricted to the given components (no whitening)
+    return (np.asarray(X) - mean) @ components.T
+
+def _kaiser_components(eigenvalues):
+    # Kaiser criterion: keep components with an eigenvalue above 1
+    return max(1, int(np.sum(eigenvalues > 1)))
+
+def pca(df_scaled, svd_solver='auto', fitted=None):
+    """Fits a single PCA, keeps the Kaiser-criterion components and projects onto them.
+
+    svd_solver is 'auto' (scikit-learn picks; for tall uploads that is the
+    one-pass covariance solver, the fastest here), 'full', 'covariance_eigh',
+    'randomized' or 'incremental'. 'randomized' is a truncated SVD: it
+    computes PCA_RANDOMIZED_COMPONENTS components and only computes more
+    while every one of them still passes the Kaiser criterion. The
+    projection (mean and kept components) goes into fitted if given.
+    """
+    from sklearn.decomposition import PCA, IncrementalPCA
+
+    df_name_grade = df_scaled[['Name', 'Grade']]
+    df_scaled_questions_only = df_scaled.drop(columns=['Name', 'Grade'])
+    n_rows, n_features = df_scaled_questions_only.shape
+
+    if svd_solver == 'randomized':
+        n_components = min(PCA_RANDOMIZED_COMPONENTS, n_rows, n_features)
+        while True:
+            pca = PCA(n_components=n_components, svd_solver='randomized', random_state=42)
+            pca.fit(df_scaled_questions_only)
+            if pca.explained_variance_[-1] <= 1 or n_components == min(n_rows, n_features):
+                break
+            n_components = min(2 * n_components, n_rows, n_features)
+    else:
+        if svd_solver == 'incremental':
+            pca = IncrementalPCA(batch_size=max(PCA_BATCH_SIZE, n_features))
+        else:
+            pca = PCA(svd_solver=svd_solver)
         pca.fit(df_scaled_questions_only)
-        eigenvalues = pca.explained_variance_
-        optimal_pc = np.sum(eigenvalues > 1)
-        pca = PCA(n_components=optimal_pc)
-        principal_components = pca.fit_transform(df_scaled_questions_only)
-        df_pca = pd.DataFrame(principal_components)
-        df_pca['Name'] = df_name_grade['Name']
-        df_pca['Grade'] = df_name_grade['Grade']
 
-        return df_pca, int(optimal_pc)
+    eigenvalues = pca.explained_variance_
+    optimal_pc = _kaiser_components(eigenvalues)
+    principal_components = _project(df_scaled_questions_only, pca.mean_, pca.components_[:optimal_pc])
+    if fitted is not None:
+        fitted['pca_mean'] = pca.mean_
+        fitted['pca_components'] = pca.components_[:optimal_pc]
+    df_pca = pd.DataFrame(principal_components)
+    df_pca['Name'] = df_name_grade['Name']
+    df_pca['Grade'] = df_name_grade['Grade']
+
+    return df_pca, optimal_pc
+
+def pca_from_chunks(make_chunks, fitted=None):
+    """Out-of-core variant of pca() built on IncrementalPCA.
+
+    make_chunks() must return a fresh iterator of scaled chunks (DataFrames
+    with Name and Grade columns); it is consumed twice, once to fit and once
+    to project, so the full scaled matrix is never held in memory. The
+    projection keeps the chunks' row index.
+    """
+    from sklearn.decomposition import IncrementalPCA
+
+    ipca = IncrementalPCA()
+    pending = None
+    for chunk in make_chunks():
+        X = chunk.drop(columns=['Name', 'Grade']).to_numpy()
+        pending = X if pending is None else np.vstack([pending, X])
+        # Every partial_fit batch needs at least as many rows as components
+        if pending.shape[0] >= pending.shape[1]:
+            ipca.partial_fit(pending)
+            pending = None
+    if pending is not None:
+        ipca.partial_fit(pending)
+
+    optimal_pc = _kaiser_components(ipca.explained_variance_)
+    components = ipca.components_[:optimal_pc]
+    if fitted is not None:
+        fitted['pca_mean'] = ipca.mean_
+        fitted['pca_components'] = components
+
+    parts = []
+    for chunk in make_chunks():
+        part = pd.DataFrame(_project(chunk.drop(columns=['Name', 'Grade']), ipca.mean_, components), index=chunk.index)
+        part['Name'] = chunk['Name']
+        part['Grade'] = chunk['Grade']
+        parts.append(part)
+    df_pca = pd.concat(parts)
+
+    return df_pca, optimal_pc
 
 def get_uploaded_result_by_uuid(id, type):
-    root_save_folder = 'results'
-    type_save_folder = os.path.join(root_save_folder, type)
-    file_path = os.path.join(type_save_folder, f'{id}.json')
-    
     try:
-        if not os.path.exists(file_path):
-            print(f"File not found: {file_path}")
-            return None
-            
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        return data
+        payload = load_results_payload(id, type)
+        return None if payload is None else json.loads(payload['identity'])
     except Exception as e:
-        print(f"Error reading results: {e}")
+        logger.exception("Error reading results %s", results_path(id, type))
         return None
 
 
@@ -0,0 +1,166 @@
+# Form type registry. Every supported questionnaire is declared here with
+# register_form(); uploads, storage and preprocessing all read their column
+# lists and answer codes from it, so adding a form type means adding one
+# register_form() call.
+
+import pandas as pd
+
+ID_COLUMNS = ['Name', 'Gender', 'Grade']
+GENDER_CODES = {'Female': 0, 'Male': 1}
+
+FORM_SCHEMAS = {}  # form type -> compiled schema
+
+
+class DatasetSchemaError(ValueError):
+    """Raised when an upload's header does not match its form type."""
+
+    def __init__(self, form_type, missing=(), extra=()):
+        self.form_type = form_type
+        self.missing = list(missing)
+        self.extra = list(extra)
+        if form_type not in FORM_SCHEMAS:
+            message = f"Unknown form type: {form_type}"
+        else:
+            message = f"Invalid {form_type} dataset: {len(self.missing)} missing, {len(self.extra)} unexpected columns"
+        super().__init__(message)
+
+
+def normalize_header(name):
+    # Spreadsheet exports differ in the line breaks inside multi-line question headers
+    return str(name).replace('\r\n', '\n').replace('\r', '\n').strip()
+
+
+def register_form(form_type, questions, answer_codes=None):
+    """Compiles and registers a form type.
+
+    questions lists the question headers in file order; answer_codes maps
+    text answers to the integer codes 0..n-1 for forms whose answers are not
+    already numeric.
+    """
+    columns = tuple(normalize_header(col) for col in ID_COLUMNS + list(questions))
+    FORM_SCHEMAS[form_type] = {
+        'columns': columns,
+        'questions': columns[len(ID_COLUMNS):],
+        'column_set': frozenset(columns),
+        'answer_codes': dict(answer_codes) if answer_codes else None,
+    }
+    return FORM_SCHEMAS[form_type]
+
+
+def get_form_schema(form_type):
+    return FORM_SCHEMAS.get(form_type)
+
+
+def answer_codes(form_type):
+    schema = FORM_SCHEMAS.get(form_type)
+    return schema['answer_codes'] if schema else None
+
+
+def answer_labels(form_type):
+    """Text answers ordered by code, so a code is its label's position; None for numeric forms."""
+    codes = answer_codes(form_type)
+    return sorted(codes, key=codes.get) if codes else None
+
+
+def upload_dtypes(form_type):
+    """pandas dtypes to parse an upload with, so answers arrive as categoricals (text) or nullable int8."""
+    schema = FORM_SCHEMAS[form_type]
+    labels = answer_labels(form_type)
+    answer_dtype = pd.CategoricalDtype(labels) if labels else 'Int8'
+    return {'Name': str, 'Gender': 'category', **{question: answer_dtype for question in schema['questions']}}
+
+
+def check_header(columns, form_type):
+    """Validates header names against the registered schema of form_type.
+
+    Returns the normalized column names. Raises DatasetSchemaError listing
+    the missing and unexpected (including repeated) columns otherwise.
+    """
+    schema = FORM_SCHEMAS.get(form_type)
+    if schema is None:
+        raise DatasetSchemaError(form_type)
+
+    columns = [normalize_header(col) for col in columns]
+    seen = set()
+    extra = []
+    for col in columns:
+        if col not in schema['column_set'] or col in seen:
+            extra.append(col)
+        seen.add(col)
+    missing = [col for col in schema['columns'] if col not in seen]
+    if missing or extra:
+        raise DatasetSchemaError(form_type, missing, extra)
+    return columns
+
+
+ASSI_A_QUESTIONS = [
+    'Because I need at least a high-school degree in order to find a high-paying job later on.',
+    'Because I experience pleasure and satisfaction while learning new things.',
+    'Because I think that a high-school education will help me better prepare for the career I have chosen.',
+    'Because I really like going to school.',
+    "Honestly, I don't know; I really feel that I am wasting my time in school.",
+    'For the pleasure I experience while surpassing myself in my studies.',
+    'To prove to myself that I am capable of completing my high-school degree.',
+    'In order to obtain a more prestigious job later on.',
+    'For the pleasure I experience when I discover new things never seen before.',
+    'Because eventually it will enable me to enter the job market in a field that I like.',
+    'Because for me, school is fun.',
+    'I once had good reasons for going to school; however, now I wonder whether I should continue.',
+    'For the pleasure that I experience while I am surpassing myself in one of my personal accomplishments.',
+    'Because of the fact that when I succeed in school I feel\nimportant.',
+    'Because I want to have "the good life" later on.',
+    'For the pleasure that I experience in broadening my\nknowledge about subjects which appeal to me.',
+    'Because this will help me make a better choice regarding my career orientation.',
+    'For the pleasure that I experience when I am taken by\ndiscussions with interesting teachers.',
+    "I can't see why I go to school and frankly, I couldn't care\nless.",
+    'For the satisfaction I feel when I am in the process of\naccomplishing difficult academic activities.',
+    'To show myself that I am an intelligent person.',
+    'In order to have a better salary later on.',
+    'Because my studies allow me to continue to learn about\nmany things that interest me.',
+    'Because I believe that my high school education will\nimprove my competence as a worker.',
+    'For the "high" feeling that I experience while reading about various interesting subjects.',
+    "I don't know; I can't understand what I am doing in school.",
+    'Because high school allows me to experience a personal satisfaction in my quest for excellence in my studies.',
+    'Because I want to show myself that I can succeed in my\nstudies.',
+]
+
+ASSI_C_QUESTIONS = [
+    'Complain of aches or pains',
+    'Spend more time alone',
+    'Tire easily, little energy',
+    'Fidgety, unable to sit still',
+    'Have trouble with teacher',
+    'Less interested in school',
+    'Act as if driven by motor',
+    'Daydream too much',
+    'Distract easily',
+    'Are afraid of new situations',
+    'Feel sad, unhappy',
+    'Are irritable, angry',
+    'Feel hopeless',
+    'Have trouble concentrating',
+    'Less interested in friends',
+    'Fight with other children',
+    'Absent from school',
+    'School grades dropping',
+    'Down on yourself',
+    'Visit doctor with doctor finding nothing\nwrong',
+    'Have trouble sleeping',
+    'Worry a lot',
+    'Want to be with parent more than before',
+    'Feel that you are bad',
+    'Take unnecessary risks',
+    'Get hurt frequently',
+    'Seem to be having less fun',
+    'Act younger than children your age',
+    'Do not listen to rules',
+    'Do not show feelings',
+    "Do not understand other people's feelings",
+    'Tease others',
+    'Blame others for your troubles',
+    'Take things that do not belong to you',
+    'Refuse to share',
+]
+
+register_form('ASSI-A', ASSI_A_QUESTIONS)
+register_form('ASSI-C', ASSI_C_QUESTIONS, answer_codes={'Never': 0, 'Sometimes': 1, 'Often': 2})
@@ -0,0 +1,360 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from src.cache import cache_get, cache_put, cache_invalidate
+from src.concurrency import atomic_path, dataset_lock
+from src.schemas import ID_COLUMNS, GENDER_CODES, answer_codes, answer_labels
+from src.metrics import inc
+
+STUDENT_DATA_FOLDER = 'student_data'
+# Rows converted and sent per chunk of a streamed export
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', 10000))
+# Formats of a streamed export -> response mimetype
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+# Nullable pandas dtypes for the compact Arrow integer columns
+_PANDAS_TYPES = {
+    pa.int8(): pd.Int8Dtype(),
+    pa.int16(): pd.Int16Dtype(),
+}
+
+
+def answer_columns(columns):
+    return [col for col in columns if col not in ID_COLUMNS and col != 'Cluster']
+
+
+def student_data_path(uuid, form_type, extension='feather'):
+    return os.path.join(STUDENT_DATA_FOLDER, form_type, f'{uuid}.{extension}')
+
+
+def encode_answer_column(values, form_type):
+    """Returns the int8 codes of one answer column in one vectorized lookup, -1 where missing or unknown.
+
+    Text answers (plain strings or categoricals) are coded through the form
+    schema; numeric columns already hold codes (e.g. a frame from
+    load_student_data) and are passed through.
+    """
+    labels = answer_labels(form_type)
+    if labels and not pd.api.types.is_numeric_dtype(values):
+        return pd.Categorical(values, categories=labels).codes
+    return pd.to_numeric(values, errors='coerce').fillna(-1).to_numpy(dtype='int8')
+
+
+def encode_features(df, form_type):
+    """Encodes Gender and the answers of df as a float32 feature frame for the ML stages, NaN where missing."""
+    features = {}
+    for col in df.columns:
+        if col == 'Gender':
+            codes = pd.Categorical(df[col], categories=list(GENDER_CODES)).codes
+        else:
+            codes = encode_answer_column(df[col], form_type)
+        features[col] = np.where(codes < 0, np.nan, codes).astype('float32')
+    return pd.DataFrame(features, index=df.index)
+
+
+def encode_student_data(df, form_type):
+    """Converts a student DataFrame into a typed Arrow table with int8 answer codes."""
+    arrays = {}
+    for col in df.columns:
+        if col == 'Name':
+            arrays[col] = pa.array(df[col].astype(str), type=pa.string())
+        elif col == 'Gender':
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                # The categories become the dictionary, so chunks with the same categories share it
+                arrays[col] = pa.array(df[col], from_pandas=True)
+            else:
+                arrays[col] = pa.array(df[col], type=pa.string(), from_pandas=True).dictionary_encode()
+        elif col == 'Grade':
+            arrays[col] = pa.array(pd.to_numeric(df[col], errors='coerce'), type=pa.int16(), from_pandas=True)
+        elif col == 'Cluster':
+            arrays[col] = pa.array(df[col], type=pa.int8(), from_pandas=True)
+        else:
+            codes = encode_answer_column(df[col], form_type)
+            arrays[col] = pa.array(codes, type=pa.int8(), mask=codes < 0)
+    return pa.table(arrays)
+
+
+def decode_answers(df, form_type):
+    """Maps answer codes back to their text labels with one vectorized lookup per column."""
+    labels = answer_labels(form_type)
+    if not labels:
+        return df
+    df = df.copy()
+    for col in answer_columns(df.columns):
+        df[col] = pd.Categorical.from_codes(df[col].fillna(-1).astype('int8'), categories=labels)
+    return df
+
+
+def decode_student_record(df_row, form_type):
+    """Converts a one-row frame into a dict of native Python values with text answers."""
+    codes = answer_codes(form_type)
+    labels = {code: label for label, code in codes.items()} if codes else {}
+    answers = set(answer_columns(df_row.columns))
+    record = {}
+    for col, value in df_row.to_dict('records')[0].items():
+        if pd.isna(value):
+            value = None
+        elif hasattr(value, 'item'):
+            value = value.item()  # numpy scalar -> native
+        if col in answers and labels:
+            value = labels.get(value, value)
+        record[col] = value
+    return record
+
+
+def latest_cluster_overrides(uuid, form_type):
+    """Returns the pending counselor reassignments of a dataset as {row offset: cluster}."""
+    # db imports this module, so the log is looked up lazily
+    from src.db import get_cluster_overrides
+
+    return {offset: cluster for _, _, offset, cluster in get_cluster_overrides(uuid, form_type)}
+
+
+def apply_cluster_overrides(df, uuid, form_type, latest=None):
+    """Merges the pending counselor reassignments from the override log into a freshly read frame.
+
+    df must be indexed by row offset in the dataset. latest is the log as
+    returned by latest_cluster_overrides, for callers applying it to many
+    frames of the same dataset.
+    """
+    if 'Cluster' not in df.columns:
+        return df
+    if latest is None:
+        latest = latest_cluster_overrides(uuid, form_type)
+    if latest:
+        mask = df.index.isin(list(latest))
+        if mask.any():
+            df.loc[mask, 'Cluster'] = df.index[mask].map(latest).astype('int8')
+    return df
+
+
+def _table_to_frame(table):
+    return table.to_pandas(types_mapper=_PANDAS_TYPES.get)
+
+
+def save_student_data(df, uuid, form_type):
+    """Writes a processed dataset as an uncompressed Feather file so it can be memory-mapped."""
+    file_path = student_data_path(uuid, form_type)
+
+    table = encode_student_data(df, form_type)
+    with atomic_path(file_path) as tmp_path:
+        feather.write_feather(table, tmp_path, compression='uncompressed')
+
+    save_student_index(build_student_index(df['Name']), uuid, form_type)
+
+    # Write-through so readers never see the previous version from the cache
+    cache_put((form_type, uuid), _table_to_frame(table))
+    return file_path
+
+
+def save_student_data_from_chunks(chunks, uuid, form_type):
+    """Writes a dataset one chunk at a time, for datasets too large to hold in memory.
+
+    chunks yields frames with text answers and Cluster, in row order. Each is
+    written as its own record batch of one Feather file, which is read back
+    like any other. The name index is built as the rows stream past. Returns
+    the number of rows written.
+    """
+    file_path = student_data_path(uuid, form_type)
+
+    genders = []
+    index = {}
+    offset = 0
+    writer = None
+    with atomic_path(file_path) as tmp_path, pa.OSFile(tmp_path, 'wb') as sink:
+        for chunk in chunks:
+            # Batches may only extend the Gender dictionary (written as deltas), never reorder it
+            genders += [gender for gender in chunk['Gender'].dropna().unique() if gender not in genders]
+            table = encode_student_data(chunk.assign(Gender=pd.Categorical(chunk['Gender'], categories=genders)), form_type)
+            if writer is None:
+                writer = pa.ipc.new_file(sink, table.schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+            writer.write_table(table)
+            for name in chunk['Name'].astype(str).tolist():
+                index.setdefault(name, []).append(offset)
+                offset += 1
+        if writer is not None:
+            writer.close()
+
+    save_student_index(index, uuid, form_type)
+    cache_invalidate((form_type, uuid))
+    return offset
+
+
+def iter_student_data(uuid, form_type):
+    """Yields a stored dataset as frames of answer codes, one per record batch, with row offsets as index."""
+    file_path = student_data_path(uuid, form_type)
+    if not os.path.exists(file_path):
+        # Datasets saved before the Feather format are converted by a full load
+        yield load_student_data(uuid, form_type)
+        return
+    reader = pa.ipc.open_file(pa.memory_map(file_path))
+    offset = 0
+    for i in range(reader.num_record_batches):
+        df = _table_to_frame(pa.Table.from_batches([reader.get_batch(i)]))
+        df.index = pd.RangeIndex(offset, offset + len(df))
+        offset += len(df)
+        yield apply_cluster_overrides(df, uuid, form_type)
+
+
+def load_student_data(uuid, form_type, columns=None):
+    """Loads a processed dataset with answers as nullable int8 codes.
+
+    Full loads are served from the shared dataset cache; the returned frame
+    is shared and must be copied before modifying it. Column subsets of an
+    uncached dataset read only those columns from disk. Datasets saved before
+    the Feather format are converted from their CSV on first access.
+    """
+    cached = cache_get((form_type, uuid))
+    if cached is not None:
+        return cached if columns is None else cached[columns]
+
+    file_path = student_data_path(uuid, form_type)
+    # The file and the override log are read as one version of the dataset
+    with dataset_lock(uuid, form_type, shared=True):
+        if not os.path.exists(file_path):
+            csv_path = student_data_path(uuid, form_type, 'csv')
+            if not os.path.exists(csv_path):
+                raise FileNotFoundError(file_path)
+            save_student_data(pd.read_csv(csv_path), uuid, form_type)
+
+        table = feather.read_table(file_path, columns=columns, memory_map=True)
+        df = apply_cluster_overrides(_table_to_frame(table), uuid, form_type)
+        if columns is None:
+            cache_put((form_type, uuid), df)
+    return df
+
+
+def append_student_data(df, uuid, form_type):
+    """Appends new student rows (text answers and Cluster) to a stored dataset.
+
+    The file is rewritten with the new rows after the existing ones, so row
+    offsets in the name index stay valid. Returns the appended rows as stored
+    (answer codes), e.g. to add them to the answer cube.
+    """
+    rows = _table_to_frame(encode_student_data(df, form_type))
+    combined = pd.concat([load_student_data(uuid, form_type), rows], ignore_index=True)
+    save_student_data(combined, uuid, form_type)
+    return rows
+
+
+def build_student_index(names):
+    """Maps each student name to its row offsets, in row order so duplicates resolve deterministically."""
+    index = {}
+    for offset, name in enumerate(names.astype(str).tolist()):
+        index.setdefault(name, []).append(offset)
+    return index
+
+
+def save_student_index(index, uuid, form_type):
+    file_path = student_data_path(uuid, form_type, 'index.json')
+    with atomic_path(file_path) as tmp_path, open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    cache_put((form_type, uuid, 'student_index'), index)
+    return file_path
+
+
+def load_student_index(uuid, form_type):
+    cached = cache_get((form_type, uuid, 'student_index'))
+    if cached is not None:
+        return cached
+
+    file_path = student_data_path(uuid, form_type, 'index.json')
+    with dataset_lock(uuid, form_type, shared=True):
+        if not os.path.exists(file_path):
+            # Datasets saved before the index existed
+            index = build_student_index(load_student_data(uuid, form_type, columns=['Name'])['Name'])
+            save_student_index(index, uuid, form_type)
+            return index
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return cache_put((form_type, uuid, 'student_index'), json.load(f))
+
+
+def lookup_student(uuid, form_type, name):
+    """Returns the row offsets of every student with this name (empty if none)."""
+    return load_student_index(uuid, form_type).get(str(name), [])
+
+
+def read_student_row(uuid, form_type, offset):
+    """Reads a single student row as a one-row DataFrame without scanning the dataset."""
+    cached = cache_get((form_type, uuid))
+    if cached is not None:
+        return cached.iloc[[offset]]
+    table = feather.read_table(student_data_path(uuid, form_type), memory_map=True)
+    df = _table_to_frame(table.slice(offset, 1))
+    df.index = pd.RangeIndex(offset, offset + 1)
+    return apply_cluster_overrides(df, uuid, form_type)
+
+
+def export_student_data_csv(uuid, form_type, path_or_buf=None):
+    """Writes a dataset as CSV with the original text answers; returns the CSV text if no target is given."""
+    df = decode_answers(load_student_data(uuid, form_type), form_type)
+    return df.to_csv(path_or_buf, index=False)
+
+
+def _export_chunk(df, file_format, header):
+    if file_format == 'ndjson':
+        text = df.to_json(orient='records', lines=True, force_ascii=False)
+        return text if text.endswith('\n') else text + '\n'
+    return df.to_csv(index=False, header=header)
+
+
+def stream_student_data(uuid, form_type, file_format='csv', columns=None, gender='all', grade='all', cluster='all'):
+    """Returns a generator of CSV or NDJSON text chunks of a dataset, with the original text answers.
+
+    Rows can be filtered as in summarize_answers and projected to columns
+    (all by default, in stored order). The file is read one slice of
+    EXPORT_CHUNK_ROWS rows at a time, so memory use does not grow with the
+    dataset. Bad arguments raise ValueError and a missing dataset raises
+    FileNotFoundError here, before the first chunk is produced. The file and
+    the override log are read-locked only while they are opened: files are
+    replaced, never rewritten in place, so the open file stays consistent
+    while a slow download holds no lock against cluster edits.
+    """
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format: {file_format}')
+    grade = grade if grade == 'all' else int(grade)
+    cluster = cluster if cluster == 'all' else int(cluster)
+
+    file_path = student_data_path(uuid, form_type)
+    if not os.path.exists(file_path):
+        # Datasets saved before the Feather format are converted by a full load
+        load_student_data(uuid, form_type, columns=['Name'])
+    stored = pa.ipc.open_file(pa.memory_map(file_path)).schema.names
+    columns = list(columns) if columns else stored
+    unknown = [column for column in columns if column not in stored]
+    if unknown:
+        raise ValueError(f'Unknown columns: {", ".join(unknown)}')
+    filters = {column: value for column, value in [('Gender', gender), ('Grade', grade), ('Cluster', cluster)] if value != 'all'}
+    needed = set(columns) | set(filters)
+    read_columns = [column for column in stored if column in needed]
+
+    with dataset_lock(uuid, form_type, shared=True):
+        latest = latest_cluster_overrides(uuid, form_type)
+        reader = pa.ipc.open_file(pa.memory_map(file_path))
+
+    def chunks():
+        header = True
+        offset = 0
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i).select(read_columns)
+            for start in range(0, batch.num_rows, EXPORT_CHUNK_ROWS):
+                df = _table_to_frame(pa.Table.from_batches([batch.slice(start, EXPORT_CHUNK_ROWS)]))
+                df.index = pd.RangeIndex(offset, offset + len(df))
+                offset += len(df)
+                df = apply_cluster_overrides(df, uuid, form_type, latest)
+                for column, value in filters.items():
+                    df = df[df[column] == value]
+                if df.empty:
+                    continue
+                inc('rows_processed_total', len(df), step='export')
+                yield _export_chunk(decode_answers(df[columns], form_type), file_format, header)
+                header = False
+        if header and file_format == 'csv':
+            # No row matched; the header alone still describes the columns
+            yield pd.DataFrame(columns=columns).to_csv(index=False)
+
+    return chunks()
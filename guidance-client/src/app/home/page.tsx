@@ -111,6 +111,8 @@ export default function HomePage() {
     );
 }
 
+const JOB_POLL_INTERVAL_MS = 2000;
+
 type FileUploadProps = {
     setData: (data: any) => void;
     form: any;
@@ -119,6 +121,28 @@ type FileUploadProps = {
 const FileUpload = ({ setData, form }: FileUploadProps) => {
     const [isLoading, setIsLoading] = useState(false);
     
+    const pollJob = useCallback((jobId: string) => {
+        axios.get(`${CONFIG.API_BASE_URL}/api/jobs/${jobId}`)
+            .then(response => {
+                const job = response.data;
+                if (job.status === 'completed') {
+                    setIsLoading(false);
+                    console.log('Success:', job.results);
+                    setData(job.results);
+                } else if (job.status === 'failed') {
+                    setIsLoading(false);
+                    alert(`Error: ${job.message || 'Processing failed'}`);
+                } else {
+                    setTimeout(() => pollJob(jobId), JOB_POLL_INTERVAL_MS);
+                }
+            })
+            .catch(error => {
+                setIsLoading(false);
+                console.error("Job status error:", error);
+                alert("Error: Could not get the processing status from the server.");
+            });
+    }, [setData]);
+
     const onDrop = useCallback((acceptedFiles: File[]) => {
         acceptedFiles.forEach((file) => {
             if (form.datasetName === "") {
@@ -152,11 +176,11 @@ const FileUpload = ({ setData, form }: FileUploadProps) => {
                 headers: { 'Content-Type': 'multipart/form-data' },
             })
                 .then(response => {
-                    setIsLoading(false);
-                    if (response.data && response.data.data) {
-                        console.log('Success:', response.data.data);
-                        setData(response.data.data);
+                    if (response.data && response.data.job_id) {
+                        console.log('Processing job started:', response.data.job_id);
+                        pollJob(response.data.job_id);
                     } else {
+                        setIsLoading(false);
                         console.error("Invalid response format:", response.data);
                         alert("Error: Invalid response from server");
                     }
@@ -180,7 +204,7 @@ const FileUpload = ({ setData, form }: FileUploadProps) => {
                     }
                 });
         });
-    }, [form, setData]);
+    }, [form, pollJob]);
 
     const { getRootProps, getInputProps, isDragActive } = useDropzone({
         onDrop,
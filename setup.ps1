@@ -2,6 +2,7 @@ cd guidance-application
 python -m venv venv
 venv/scripts/activate
 pip intall -r requirements.txt
+python -m flask --app app init-db
 cd ..
 cd guidance-client
 docker build -t client .
\ No newline at end of file